@@ -1,65 +1,98 @@
-from crossref.restful import Works, Etiquette
-from time import sleep
+from time import sleep, perf_counter
+from threading import Event
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import quote
+from cache import response_cache
+from network import get_session, get_backend_health, get_rate_limiter
+from streaming import is_streaming_available, build_address_trie, get_trie_signature, load_pruned
 from aux import logger, program_headers, \
-    get_data_by_address, get_date_part, \
+    get_date_part, \
     format_title, format_isbn, format_names_to_last_first, title_case_names, \
     format_base_citation_code, replace_special_characters, \
-    openlibrary_url, googlebooks_url, \
+    crossref_url, openlibrary_url, googlebooks_url, \
     missing_data_string, array_separator, \
-    concat_separator, citation_code_format, header_addresses, \
-    timeout, num_retries, retry_delay, \
+    concat_separator, citation_code_format, info_headers, compiled_header_addresses, get_address_root_keys, \
+    header_addresses, timeout, num_retries, num_workers, batch_size, stream_responses, \
     project_name, project_version, project_url, contact_email, \
-    primary_isbn, secondary_isbn
+    primary_isbn, secondary_isbn, hedged_isbn, hedge_grace_period
 import requests
 import re
 from datetime import datetime
 
 ### api classes
 class _GenWorks:
-    citation_dict = None
     etiquette = None
+    response_root = None    # key holding the record in responses, if any
+    validate_keys = []      # keys used by _validate
 
     def __init__(self, url=None):
         self.api_class_name = self.__class__.__name__
         self.api_name = self.api_class_name.replace("Works", "").lower()
-        self.api_header_addresses = header_addresses[self.api_name]
-        self.api_header_address_root = (self.api_header_addresses.pop("/") + ".") if "/" in self.api_header_addresses else ""
+        self.api_header_extractors = compiled_header_addresses[self.api_name]
         self.url = url
+        self.prefetched_responses = {} # lowercase id_num: validated response
+        # responses are streamed and pruned to the keys used in addresses if possible
+        self.response_trie = None
+        if stream_responses and is_streaming_available():
+            api_header_addresses = header_addresses[self.api_name]
+            root_address = (api_header_addresses["/"] + ".") if "/" in api_header_addresses else ""
+            if self.response_root is not None:
+                root_address = self.response_root + "." + root_address
+            self.response_trie = build_address_trie(
+                self.validate_keys + [root_address + address for header, address in api_header_addresses.items() if header != "/"]
+            )
+        # signatures of partial responses in the cache that hold all needed data
+        self.cache_fields = () if self.response_trie is None else (get_trie_signature(self.response_trie),)
         if self.api_name == "crossref":
             self.id_num_type = "doi"
         elif self.api_name in ("openlibrary", "googlebooks"):
             self.id_num_type = "isbn"
+        if all(x is not None for x in [project_name, project_version, project_url, contact_email]):
+            logger.debug(f"{self.api_class_name}: polite api settings found in settings.json, sharing with api as headers")
+            self.etiquette = {"User-Agent": f"{project_name}/{project_version} ({project_url}; mailto:{contact_email})"}
+        else:
+            logger.debug(f"{self.api_class_name}: polite api settings not found in settings.json, using api anonymously")
 
-    def _request(self, id_num):
-        logger.error("Not Implimented Error", f"Should not call private method _request() from base class {self.api_name}")
+    def _request(self, id_num, request_timeout):
+        url = self.url + quote(id_num, safe="/")
+        with get_session(url).get(url, timeout=request_timeout, headers=self.etiquette, stream=self.response_trie is not None) as response:
+            get_rate_limiter(self.api_class_name, self.api_name).update_from_response(response)
+            if response.status_code >= 500 or response.status_code == 429:
+                response.raise_for_status() # server errors and rate limiting are retried
+            if response.status_code == 200:
+                if self.response_trie is None:
+                    return self._validate(response.json())
+                response.raw.decode_content = True
+                return self._validate(load_pruned(response.raw, self.response_trie))
+        logger.debug(f"{self.api_class_name}: HTTP error {response.status_code} while retrieving {self.id_num_type} \"{id_num}\"")
+        return None
+    
+    def _validate(self, response):
+        logger.error("Not Implimented Error", f"Should not call private method _validate() from base class {self.api_name}")
 
-    def get_csv_row(self, id_num, custom_base_citation_code=None):
+    def get_csv_row(self, id_num, custom_base_citation_code=None, cancel_event=None):
         logger.debug(f"Calling {self.api_name} api for {self.id_num_type} \"{id_num}\"")
         id_num = self._format_id_num(id_num)
-        response = self.get_work(id_num)
-        self.citation_dict = None
+        response = self.get_work(id_num, cancel_event)
         if response is None:
             return None
         else:
             # make framework dict
             logger.debug(f"{self.api_class_name}: creating csv row for {self.id_num_type} \"{id_num}\"")
-            if any(header not in header_addresses["info_headers"] for header in self.api_header_addresses):
-                logger.error("Bad Header", f"{self.api_class_name}: in settings.json, headers exist for {self.api_name} that are absent in \"info_headers\".")
-            self.citation_dict = {header: missing_data_string for header in header_addresses["info_headers"] + program_headers}
+            citation_dict = {header: missing_data_string for header in info_headers + program_headers}
             logger.debug(f"{self.api_class_name}: adding content for \"add-date\" and \"{self.id_num_type}\" fields for {self.id_num_type} \"{id_num}\"")
-            self.citation_dict["add-date"] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-            self.citation_dict[self.id_num_type] = id_num
+            citation_dict["add-date"] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+            citation_dict[self.id_num_type] = id_num
             # add in header items
             logger.debug(f"{self.api_class_name}: filling in data for other fields from response for {self.id_num_type} \"{id_num}\"")
-            for header, address in self.api_header_addresses.items():
-                address = self.api_header_address_root + address
-                needs_processing, data = get_data_by_address(response, address)
-                self.citation_dict[header] = self._process_data(header, data) if needs_processing else data
+            for header, extract in self.api_header_extractors.items():
+                needs_processing, data = extract(response)
+                citation_dict[header] = self._process_data(header, data) if needs_processing else data
             # set code
             logger.debug(f"Creating citation code base for {self.id_num_type} \"{id_num}\"")
-            self._set_base_citation_code(custom_base_citation_code)
+            self._set_base_citation_code(citation_dict, custom_base_citation_code)
             # return completed dict
-            return self.citation_dict
+            return citation_dict
     
     def _format_id_num(self, id_num):
         match self.id_num_type:
@@ -71,12 +104,12 @@ class _GenWorks:
     def _process_data(self, header, data):
         logger.error("Unhandled Header", f"The @ symbol was used in the address for {header} but not handled by {self.api_class_name}._process_data")
 
-    def _set_base_citation_code(self, custom_citation_code=None):
+    def _set_base_citation_code(self, citation_dict, custom_citation_code=None):
         if isinstance(custom_citation_code, str):
             final_string = format_base_citation_code(custom_citation_code)
         else:
             matches = [(match.group(1), match.span()) for match in re.finditer(r"<([a-z\-]*?.?[a-z]*?)>", citation_code_format)]
-            first_author_name = self.citation_dict["author"].split(array_separator, 1)[0]
+            first_author_name = citation_dict["author"].split(array_separator, 1)[0]
             if first_author_name is missing_data_string:
                 first_author_family_name, first_author_given_name = (missing_data_string,) * 2
             elif first_author_name.count(concat_separator) == 0:
@@ -87,7 +120,7 @@ class _GenWorks:
                 "firstauthor.family": first_author_family_name,
                 "firstauthor.given": first_author_given_name
             }
-            bad_keys = [match[0] for match in matches if match[0] not in self.citation_dict and match[0] not in special_keys]
+            bad_keys = [match[0] for match in matches if match[0] not in citation_dict and match[0] not in special_keys]
             if len(bad_keys) > 0:
                 logger.error("Bad citation code format", f"cannot interpret <{bad_keys[0]}> in \"citation-code_format\" in settings.json")
             all_indx_cutoffs = [0] + [indx for match in matches for indx in match[1]] + [len(citation_code_format)]
@@ -95,47 +128,157 @@ class _GenWorks:
             final_string = ""
             for non_match_indx_range, (group, _) in zip(non_match_indx_ranges[:-1], matches):
                 final_string += citation_code_format[slice(*non_match_indx_range)] 
-                final_string += str(self.citation_dict[group]) if group in self.citation_dict else special_keys[group]
+                final_string += str(citation_dict[group]) if group in citation_dict else special_keys[group]
             final_string += citation_code_format[slice(*non_match_indx_ranges[-1])]
             final_string = format_base_citation_code(final_string)
-        self.citation_dict["citation-code"] = final_string
+        citation_dict["citation-code"] = final_string
         logger.debug(f"Created citation code base: \"{final_string}\"")
 
-    def get_work(self, id_num):
+    def get_work(self, id_num, cancel_event=None):
+        """
+        Gets the validated response for id_num from the cache or the api. If cancel_event 
+        is given and set, no further attempts are made and None is returned.
+        """
         id_num = id_num.rstrip()
         if id_num == "":
             logger.debug(f"{self.api_class_name}: {self.id_num_type} provided is empty. Skipping")
             return None
+        response = response_cache.get(self.api_name, id_num, self.cache_fields)
+        if response is not None:
+            logger.progress(f"{self.api_class_name}: Retrieved cached data for {self.id_num_type} \"{id_num}\"")
+            return response
+        response = self.prefetched_responses.pop(id_num.lower(), None)
+        if response is not None:
+            logger.progress(f"{self.api_class_name}: Retrieved batched data for {self.id_num_type} \"{id_num}\"")
+            return response
+        health = get_backend_health(self.api_class_name)
+        rate_limiter = get_rate_limiter(self.api_class_name, self.api_name)
         for i in range(num_retries):
-            logger.debug(f"{self.api_class_name}: Attempt {i+1} to retrieve {self.id_num_type} \"{id_num}\"")
+            if cancel_event is not None and cancel_event.is_set():
+                logger.debug(f"{self.api_class_name}: Request for {self.id_num_type} \"{id_num}\" cancelled")
+                return None
+            if not health.allow_request():
+                logger.progress(f"{self.api_class_name}: Skipping {self.id_num_type} \"{id_num}\" since the api is failing")
+                return None
+            # a trial request of the circuit breaker must end even if no result is recorded
             try:
-                response = self._request(id_num)
+                if not rate_limiter.acquire(cancel_event):
+                    logger.debug(f"{self.api_class_name}: Request for {self.id_num_type} \"{id_num}\" cancelled")
+                    return None
+                request_timeout = health.get_timeout()
+                logger.debug(f"{self.api_class_name}: Attempt {i+1} to retrieve {self.id_num_type} \"{id_num}\" with {request_timeout:.1f} second timeout")
+                start_time = perf_counter()
+                try:
+                    response = self._request(id_num, request_timeout)
+                except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as e:
+                    is_rate_limited = isinstance(e, requests.exceptions.HTTPError) and e.response.status_code == 429
+                    if is_rate_limited:
+                        failure_type = "Rate limited"
+                    else:
+                        health.record_failure(request_timeout if isinstance(e, requests.exceptions.Timeout) else None)
+                        failure_type = "Timeout" if isinstance(e, requests.exceptions.Timeout) else e.__class__.__name__
+                    if i == num_retries - 1:
+                        logger.progress(f"{self.api_class_name}: {failure_type} while retrieving {self.id_num_type} \"{id_num}\". No more retries left. Moving on")
+                        return None
+                    if is_rate_limited:
+                        continue # rate limiter waits as long as the api asked
+                    delay = health.get_backoff_delay(i)
+                    logger.debug(f"{self.api_class_name}: {failure_type} while retrieving {self.id_num_type} \"{id_num}\". Sleeping for {delay:.1f} seconds")
+                    if cancel_event is None:
+                        sleep(delay)
+                    elif cancel_event.wait(delay):
+                        logger.debug(f"{self.api_class_name}: Request for {self.id_num_type} \"{id_num}\" cancelled")
+                        return None
+                    continue
+                except Exception as e:
+                    logger.error(e, f"{self.api_class_name}: Exception while retrieving {self.id_num_type} \"{id_num}\"")
+                health.record_success(perf_counter() - start_time)
                 if response is None:
                     logger.progress(f"{self.api_class_name}: Received \"None\" response for {self.id_num_type} \"{id_num}\". Skipping")
                 else:
                     logger.progress(f"{self.api_class_name}: Successfully retrieved data for {self.id_num_type} \"{id_num}\"")
+                    response_cache.set(self.api_name, id_num, response, self.cache_fields[0] if len(self.cache_fields) > 0 else None)
                 return response
-            except requests.exceptions.Timeout:
-                if i == num_retries - 1:
-                    logger.progress(f"{self.api_class_name}: Timeout while retrieving {self.id_num_type} \"{id_num}\". No more retries left. Moving on")
-                    return None
-                logger.debug(f"{self.api_class_name}: Timeout while retrieving {self.id_num_type} \"{id_num}\". Sleeping for {retry_delay} seconds")
-                sleep(retry_delay)
-            except Exception as e:
-                logger.error(e, f"{self.api_class_name}: Exception while retrieving {self.id_num_type} \"{id_num}\"")
+            finally:
+                health.end_attempt()
 
 class CrossRefWorks(_GenWorks):
+    response_root = "message"
+    validate_keys = ["status"]
+
     def __init__(self):
-        super().__init__()
-        if all(x is not None for x in [project_name, project_version, project_url, contact_email]):
-            logger.debug(f"{self.api_class_name}: polite api settings found in settings.json, using them for etiquette")
-            self.etiquette = Etiquette(project_name, project_version, project_url, contact_email)
-        else:
-            logger.debug(f"{self.api_class_name}: polite api settings not found in settings.json, using default api")
-        self.works = Works(timeout=timeout, etiquette=self.etiquette)
+        super().__init__(crossref_url)
+        self.batch_url = crossref_url.rstrip("/")
+        # only the fields used by csv_headers are requested in batches
+        self.select_fields = ",".join(sorted(set(get_address_root_keys(self.api_name)) | {"DOI"}))
+        self.cache_fields = self.cache_fields + (self.select_fields,)
+
+    def prefetch(self, id_nums):
+        """
+        Retrieves many DOIs with one request per batch_size DOIs, holding the responses for
+        get_work. DOIs that are cached or missing from a batch are left to get_work.
+        """
+        if batch_size is None or batch_size <= 1:
+            return
+        id_nums_to_fetch = {}
+        for id_num in id_nums:
+            id_num = self._format_id_num(id_num)
+            # commas cannot be used in a doi filter
+            if id_num == "" or "," in id_num or id_num.lower() in id_nums_to_fetch or id_num.lower() in self.prefetched_responses:
+                continue
+            if response_cache.get(self.api_name, id_num, self.cache_fields) is None:
+                id_nums_to_fetch[id_num.lower()] = id_num
+        id_nums_to_fetch = list(id_nums_to_fetch.values())
+        for indx in range(0, len(id_nums_to_fetch), batch_size):
+            self._request_batch(id_nums_to_fetch[indx:indx + batch_size])
+
+    def _request_batch(self, id_nums):
+        health, rate_limiter = get_backend_health(self.api_class_name), get_rate_limiter(self.api_class_name, self.api_name)
+        if not health.allow_request():
+            return
+        try:
+            self._send_batch(id_nums, health, rate_limiter)
+        finally:
+            health.end_attempt()
+
+    def _send_batch(self, id_nums, health, rate_limiter):
+        rate_limiter.acquire()
+        params = {"filter": ",".join("doi:" + id_num for id_num in id_nums), "rows": len(id_nums)}
+        if self.select_fields is not None:
+            params["select"] = self.select_fields
+        logger.debug(f"{self.api_class_name}: Requesting batch of {len(id_nums)} dois")
+        try:
+            response = get_session(self.batch_url).get(self.batch_url, params=params, timeout=timeout, headers=self.etiquette)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            health.record_failure()
+            logger.debug(f"{self.api_class_name}: {e.__class__.__name__} while requesting batch of dois, requesting them one at a time instead")
+            return
+        rate_limiter.update_from_response(response)
+        if response.status_code == 400 and self.select_fields is not None:
+            logger.debug(f"{self.api_class_name}: api did not accept selecting fields {self.select_fields}, requesting full records instead")
+            self.select_fields = None
+            return self._send_batch(id_nums, health, rate_limiter)
+        if response.status_code != 200:
+            if response.status_code >= 500:
+                health.record_failure()
+            logger.debug(f"{self.api_class_name}: HTTP error {response.status_code} while requesting batch of dois, requesting them one at a time instead")
+            return
+        health.record_success()
+        message = self._validate(response.json())
+        if message is None or not isinstance(message.get("items"), list):
+            return
+        id_nums_by_lower = {id_num.lower(): id_num for id_num in id_nums}
+        for item in message["items"]:
+            lower_id_num = str(item.get("DOI", "")).lower()
+            if lower_id_num in id_nums_by_lower:
+                self.prefetched_responses[lower_id_num] = item
+                response_cache.set(self.api_name, id_nums_by_lower[lower_id_num], item, self.select_fields)
+        logger.debug(f"{self.api_class_name}: Found {len(message['items'])} of {len(id_nums)} dois in batch")
     
-    def _request(self, id_num):
-        return self.works.doi(id_num)
+    def _validate(self, response):
+        if response.get("status") != "ok" or "message" not in response:
+            return None
+        return response["message"]
     
     def _process_data(self, header, data):
         # crossref types: https://crossref.gitlab.io/knowledge_base/docs/topics/content-types/
@@ -160,28 +303,11 @@ class CrossRefWorks(_GenWorks):
                 
 class _ISBNWorks(_GenWorks):
     def __init__(self, url):
-        super().__init__()
-        self.url = url
-        if all(x is not None for x in [project_name, project_version, project_url, contact_email]):
-            logger.debug(f"{self.api_class_name}: polite api settings found in settings.json, sharing with api as headers")
-            self.etiquette = {
-                "User-Agent": f"{project_name}/{project_version} ({project_url}; mailto:{contact_email})",
-                "Accept": "application/json"
-            }
-        else:
-            logger.debug(f"{self.api_class_name}: polite api settings not found in settings.json, using api anonymously")
-    
-    def _request(self, id_num):
-        response = requests.get(self.url + id_num, timeout=timeout, headers=self.etiquette)
-        if response.status_code == 200:
-            return self._validate(response.json())
-        logger.debug(f"{self.api_class_name}: HTTP error {response.status_code} while retrieving {self.id_num_type} \"{id_num}\"")
-        return None
-    
-    def _validate(self, response):
-        logger.error("Not Implimented Error", f"Should not call private method _validate() from base class {self.api_name}")
+        super().__init__(url)
 
 class OpenLibraryWorks(_ISBNWorks):
+    validate_keys = ["numFound"]
+
     def __init__(self):
         super().__init__(openlibrary_url)
     
@@ -209,6 +335,8 @@ class OpenLibraryWorks(_ISBNWorks):
         super()._process_data(header, data)
 
 class GoogleBooksWorks(_ISBNWorks):
+    validate_keys = ["totalItems"]
+
     def __init__(self):
         super().__init__(googlebooks_url)
     
@@ -242,6 +370,7 @@ class GoogleBooksWorks(_ISBNWorks):
 
 class CiteWorks:
     doi_api, isbn_api1, isbn_api2 = (None,) * 3
+    hedge_executor = None
 
     def get_csv_row(self, id_num, id_num_type, custom_base_code=None):
         citation_dict = None
@@ -250,13 +379,81 @@ class CiteWorks:
             citation_dict = self.doi_api.get_csv_row(id_num, custom_base_citation_code=custom_base_code)
         elif id_num_type == "isbn":
             self._init_isbn_api()
-            citation_dict = self.isbn_api1.get_csv_row(id_num, custom_base_citation_code=custom_base_code)
-            if citation_dict is None and self.isbn_api2 is not None:
-                citation_dict = self.isbn_api2.get_csv_row(id_num, custom_base_citation_code=custom_base_code)
+            if self.hedge_executor is not None:
+                citation_dict = self._get_hedged_isbn_csv_row(id_num, custom_base_code)
+            else:
+                citation_dict = self.isbn_api1.get_csv_row(id_num, custom_base_citation_code=custom_base_code)
+                if citation_dict is None and self.isbn_api2 is not None:
+                    citation_dict = self.isbn_api2.get_csv_row(id_num, custom_base_citation_code=custom_base_code)
         if citation_dict is None:
             logger.progress(f"Unable to obtain data from apis for {id_num_type} {id_num}. If you desire to add this citation, it must be manually entered into the citations csv with a manually-created unique citation code (with suffix) and other known information.")
         return citation_dict
+
+    def get_csv_rows(self, entry_infos):
+        """
+        Fetches csv rows for a list of (id_num, id_num_type, custom_base_code) tuples 
+        concurrently, returning the rows (or None) in the same order as given.
+        """
+        if len(entry_infos) == 0:
+            return []
+        # apis are created up front so that worker threads never race to create them
+        if any(entry_info[1] == "doi" for entry_info in entry_infos):
+            self._init_doi_api()
+            self.doi_api.prefetch([entry_info[0] for entry_info in entry_infos if entry_info[1] == "doi"])
+        if any(entry_info[1] == "isbn" for entry_info in entry_infos):
+            self._init_isbn_api()
+        worker_count = max(1, min(num_workers, len(entry_infos)))
+        logger.debug(f"Fetching {len(entry_infos)} entries from apis with {worker_count} workers")
+        if worker_count == 1:
+            return [self.get_csv_row(*entry_info) for entry_info in entry_infos]
+        executor = ThreadPoolExecutor(max_workers=worker_count)
+        try:
+            futures = [executor.submit(self.get_csv_row, *entry_info) for entry_info in entry_infos]
+            return [future.result() for future in futures]
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
     
+    def _get_hedged_isbn_csv_row(self, id_num, custom_base_code=None):
+        """
+        Queries both isbn apis at once. The primary api's row is used if it arrives within
+        the grace period, otherwise the first valid row from either api is used. The other 
+        request is then cancelled.
+        """
+        cancel_event = Event()
+        primary_future, secondary_future = [
+            self.hedge_executor.submit(isbn_api.get_csv_row, id_num, custom_base_code, cancel_event)
+            for isbn_api in (self.isbn_api1, self.isbn_api2)
+        ]
+        try:
+            wait([primary_future], timeout=hedge_grace_period)
+            if primary_future.done() and primary_future.exception() is None and primary_future.result() is not None:
+                return primary_future.result()
+            logger.debug(f"{self.isbn_api1.api_class_name}: No valid response for isbn \"{id_num}\" within {hedge_grace_period} seconds, also accepting {self.isbn_api2.api_class_name}")
+            pending_futures, first_exception = {primary_future, secondary_future}, None
+            while len(pending_futures) > 0:
+                done_futures, pending_futures = wait(pending_futures, return_when=FIRST_COMPLETED)
+                # prefer primary if both finished together
+                for future in (primary_future, secondary_future):
+                    if future not in done_futures:
+                        continue
+                    if future.exception() is not None:
+                        first_exception = first_exception or future.exception()
+                    elif future.result() is not None:
+                        return future.result()
+            # only fail if neither api gave a row
+            if first_exception is not None:
+                raise first_exception
+            return None
+        finally:
+            cancel_event.set()
+            primary_future.cancel()
+            secondary_future.cancel()
+
+    def close(self):
+        if self.hedge_executor is not None:
+            self.hedge_executor.shutdown(wait=False, cancel_futures=True)
+            self.hedge_executor = None
+
     def _init_doi_api(self):
         if self.doi_api == None:
             self.doi_api = CrossRefWorks()
@@ -279,4 +476,8 @@ class CiteWorks:
             if self.isbn_api2 is None:
                 self.isbn_api2 = GoogleBooksWorks()
         elif secondary_isbn is not None:
-            logger.error("Invalid Secondary isbn api", f"The secondary isbn api provided must be \"openlibrary\", \"googlebooks\", or \"null\", and cannot be a repeat of the primary, but found {primary_isbn}")
\ No newline at end of file
+            logger.error("Invalid Secondary isbn api", f"The secondary isbn api provided must be \"openlibrary\", \"googlebooks\", or \"null\", and cannot be a repeat of the primary, but found {primary_isbn}")
+        # hedging, on its own workers so lookups never wait on each other for a worker
+        if hedged_isbn and self.isbn_api2 is not None and self.hedge_executor is None:
+            logger.debug("Hedged isbn lookup enabled, querying both isbn apis at once")
+            self.hedge_executor = ThreadPoolExecutor(max_workers=2 * max(1, num_workers))
\ No newline at end of file
@@ -21,7 +21,9 @@ class Log:
 
     def __init__(self):
         self.all_warnings = ""
-        self.log = open(join(project_path, "citation.log"), "w") if self.create_log_file else None
+        # the log file is only opened once the program does more than start up
+        self.log = None
+        self.pending_log_lines = []
         self.debug("Creating logger")
         if self.log_level < 0 or self.log_level > 2:
             self.error("ValueError", "log_level in settings.json must be between 0 and 2")
@@ -33,14 +35,13 @@ class Log:
             error = error.__class__.__name__
             error_traceback = "\n" + "-" * 30 + "\n" + traceback.format_exc()
         error_str = f">>> ERROR ({error}): {message}{error_traceback}"
-        if self.create_log_file:
-            self.log.write(error_str + "\n")
+        self._write(error_str, open_file=True)
         print(error_str)
         if kill:
             self.close()
             sys.exit(2)
         else:
-            raise CommandCiteError
+            raise CommandCiteError(f"{error}: {message}")
     
     def progress(self, message:str, title_message:bool=False):
         if title_message:
@@ -48,8 +49,7 @@ class Log:
             upper_cap = "╭" + h_line + "╮"
             lower_cap = "╰" + h_line + "╯"
             message = upper_cap + f"\n{v_line} " + message + f" {v_line}\n" + lower_cap
-        if self.create_log_file:
-            self.log.write(message + "\n")
+        self._write(message, open_file=True)
         if self.log_level >= 1:
             print(message)
     
@@ -58,8 +58,7 @@ class Log:
     
     def debug(self, message:str):
         message = f"> DEBUG: {message}"
-        if self.create_log_file:
-            self.log.write(message + "\n")
+        self._write(message)
         if self.log_level == 2:
             print(message)
     
@@ -68,24 +67,54 @@ class Log:
     
     def close(self):
         print(self.all_warnings)
-        self.log.write(self.all_warnings)
-        self.log.close()
+        if self.all_warnings:
+            self._write(self.all_warnings, open_file=True)
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def _write(self, message:str, open_file:bool=False):
+        if not self.create_log_file:
+            return
+        if self.log is None:
+            if not open_file:
+                self.pending_log_lines.append(message)
+                return
+            self.log = open(join(project_path, "citation.log"), "w")
+            self.log.writelines(line + "\n" for line in self.pending_log_lines)
+            self.pending_log_lines.clear()
+        self.log.write(message + "\n")
 
 logger = Log()
 
 def _get_path(settings_dict:dict, extension:str="", check_field:str|None=None):
     directory = settings_dict["directory"]
     directory = directory if isabs(directory) else join(project_path, directory)
-    if not exists(directory):
-        logger.error("Folder Missing", f"The folder {directory} does not exist")
     complete_path = join(directory, settings_dict["filename"]) + extension if extension else directory
     return complete_path if check_field is None or settings_dict[check_field] else None
 
+def check_directory(directory:str):
+    """Stops the program if a folder from settings.json does not exist. Called when the folder is first used."""
+    if not exists(directory):
+        logger.error("Folder Missing", f"The folder {directory} does not exist")
+
 try:
     logger.debug("Beginning to load settings from settings.json for aux.py")
     # citations csv settings
     logger.debug("Loading citations csv settings from settings.json")
     csv_file_name = _get_path(settings["citations_csv"], extension=".csv")
+    journal_dir_name = csv_file_name[:-len(".csv")] + "_journal"
+    snapshot_file_name = csv_file_name[:-len(".csv")] + "_snapshot.pickle"
+    checkpoint_file_name = csv_file_name[:-len(".csv")] + "_import_checkpoint.json"
+    retry_file_name = csv_file_name[:-len(".csv")] + "_retry.txt"
+    library_db_file_name = csv_file_name[:-len(".csv")] + ".sqlite"
+    storage = settings["citations_csv"]["storage"]
+    if storage not in ("csv", "sqlite"):
+        logger.error("ValueError", "storage in settings.json must be \"csv\" or \"sqlite\"")
+    use_snapshot = settings["citations_csv"]["use_snapshot"]
+    watch_poll_interval = settings["citations_csv"]["watch_poll_interval"]
+    watch_debounce = settings["citations_csv"]["watch_debounce"]
+    import_chunk_size = settings["citations_csv"]["import_chunk_size"]
     missing_data_string = settings["citations_csv"]["missing_data_string"]
     array_separator = settings["citations_csv"]["array_separator"]
     concat_separator = settings["citations_csv"]["concat_separator"]
@@ -101,6 +130,7 @@ try:
     automate_pdf_link_book = settings["markdown"]["automate_pdf_link"]["book"]
     included_properties = settings["markdown"]["included_properties"]
     user_defined_properties = settings["markdown"]["user-defined_properties"]
+    md_num_workers = settings["markdown"]["num_workers"]
     # bibliography settings
     logger.debug("Loading bibliography settings from settings.json")
     bibtex_file_name = _get_path(settings["bibliography"], extension=".bib", check_field="make_bibtex")
@@ -112,10 +142,26 @@ try:
     timeout = settings["network"]["timeout"]
     num_retries = settings["network"]["num_retries"]
     retry_delay = settings["network"]["retry_delay"]
+    max_retry_delay = settings["network"]["max_retry_delay"]
+    min_timeout = settings["network"]["min_timeout"]
+    breaker_threshold = settings["network"]["breaker_threshold"]
+    breaker_cooldown = settings["network"]["breaker_cooldown"]
+    rate_limits = settings["network"]["rate_limits"]
+    batch_size = settings["network"]["batch_size"]
+    stream_responses = settings["network"]["stream_responses"]
+    serve_port = settings["network"]["serve_port"]
+    num_workers = settings["network"]["num_workers"]
+    pool_size = settings["network"]["pool_size"]
+    use_cache = settings["network"]["use_cache"]
+    cache_ttl_days = settings["network"]["cache_ttl_days"]
+    cache_max_entries = settings["network"]["cache_max_entries"]
+    response_cache_file_name = csv_file_name[:-len(".csv")] + "_cache.sqlite"
     # api preference settings
     logger.debug("Loading api preference settings from settings.json")
     primary_isbn = settings["api_preference"]["primary_isbn"]
     secondary_isbn = settings["api_preference"]["secondary_isbn"]
+    hedged_isbn = settings["api_preference"]["hedged_isbn"]
+    hedge_grace_period = settings["api_preference"]["hedge_grace_period"]
     # polite api settings
     logger.debug("Loading polite api settings from settings.json")
     project_name = settings["polite_api"]["project_name"]
@@ -124,6 +170,7 @@ try:
     contact_email = settings["polite_api"]["contact_email"]
     # advanced settings
     logger.debug("Loading advanced settings from settings.json")
+    crossref_url = settings["advanced"]["api"]["crossref"]["url"]
     openlibrary_url = settings["advanced"]["api"]["openlibrary"]["url"]
     googlebooks_url = settings["advanced"]["api"]["googlebooks"]["url"]
     read_encoding = settings["advanced"]["file_encoding"]["read_encoding"]
@@ -131,7 +178,7 @@ try:
     info_headers = settings["advanced"]["csv_headers"]["info_headers"]
     header_addresses = settings["advanced"]["csv_headers"]
     if any(x not in header_addresses for x in ["crossref", "openlibrary", "googlebooks"]):
-        logger.error("settings.json file is missing required keys in advanced.csv_headers")
+        logger.error("Missing Settings", "settings.json file is missing required keys in advanced.csv_headers")
     logger.debug("Finished loading settings from settings.json for aux.py")
 except KeyError as e:
     logger.error(e, "settings.json file is missing required keys")
@@ -160,6 +207,55 @@ help_string = """FLAGS:
 [doi-or-isbn] --setcode [new-base-code]    For a given DOI or ISBN, set the citation 
                                            code to have a base code of [new-base-code]
 
+--from-file [path]                         Add the DOIs/ISBNs listed in the file at 
+                                           [path] (or - to read them from stdin), 
+                                           one per line and optionally followed by 
+                                           --setcode [new-base-code], saving every 
+                                           few lines so that running the same 
+                                           command again continues where an 
+                                           interrupted import stopped, and listing 
+                                           ids that could not be fetched in a 
+                                           retry file next to the citations csv
+
+--isolate-failures                         Save each entry that is updated or added 
+                                           even if others fail, skipping the failed 
+                                           ones and listing them in a retry file 
+                                           next to the citations csv that can be 
+                                           used with --from-file
+
+--rebuild-markdown                         Re-create the yaml frontmatter of every 
+                                           markdown file from the citations csv 
+                                           without using the network, keeping 
+                                           user-edited properties (use after 
+                                           changing markdown settings)
+
+--no-cache                                 Do not read or save api responses in the 
+                                           api response cache for this run
+
+--purge-cache                              Delete all saved api responses from the 
+                                           api response cache before running
+
+--watch                                    Keep running, and whenever the citations 
+                                           csv is edited, apply the changed rows to 
+                                           the markdown and bibliography files 
+                                           (stop with Ctrl+C)
+
+--serve                                    Keep running as a local web service at 
+                                           http://127.0.0.1:<serve_port> so other 
+                                           programs can add, update, rename, and 
+                                           look up entries without starting this 
+                                           program each time (stop with Ctrl+C)
+
+--import-csv                               When entries are stored in a database 
+                                           (see citations_csv.storage), replace 
+                                           them with the rows of the citations csv 
+                                           before running
+
+--export-csv                               When entries are stored in a database 
+                                           (see citations_csv.storage), write them 
+                                           to the citations csv after running, so 
+                                           they can be edited in a spreadsheet
+
 Other than the restrictions listed below, any sequence or repetition of flags, DOIs 
 or ISBNs can be given to this program.
 
@@ -168,6 +264,15 @@ NOTES:
     --help cannot be used in combination with other flags
               
     --update-all and --update cannot be used together
+
+    --rebuild-markdown, --watch, --serve, and --from-file cannot be used with 
+    --update-all, --update, --rename, or DOIs/ISBNs
+
+    --import-csv and --export-csv can only be used when citations_csv.storage is 
+    "sqlite", and --watch can only be used when it is "csv"
+
+    --isolate-failures cannot be used with --no-cache or when network.use_cache 
+    is false
               
     For markdown documents, --rename only updates the specified code in file names 
     and the yaml frontmatter, not note text"""
@@ -339,65 +444,117 @@ def is_valid_citation_code(code:str) -> bool:
 # data retrieval and formatting functions
 def get_data_by_address(data:dict|list|str|int|bool, address:str) -> tuple[bool,any]:
     """Return the location at a given address, or missing_data_string if missing."""
+    return compile_address(address)(data)
+
+def compile_address(address:str):
+    """
+    Compiles a response address from \"csv_headers\" in settings.json into a function that 
+    takes a response and returns (needs_processing, data), where data is missing_data_string
+    if no address option leads to data.
+    """
     if match := re.match(r".*\[.*?([\.\*\[\]]).*?\].*", address):
         logger.error("Misuse of [] in Response Address", f"The [] address notation in \"csv_headers\" of settings.json should only hold individual keys or indices separated by commas, but contained a \"{match.group(1)}\".")
-    address_options = address.split("|")
-    for address in address_options:
-        if needs_processing := address.endswith("@"):
-            address = address[:-1]
-        data_chunk = data
-        address_parts = address.split(".")
-        for part_indx, part in enumerate(address_parts):
-            # handle missing data
-            if data_chunk in []:
-                data_chunk = missing_data_string
+    address_options = []
+    for address_option in address.split("|"):
+        if needs_processing := address_option.endswith("@"):
+            address_option = address_option[:-1]
+        address_options.append((needs_processing, _compile_address_parts(address_option.split("."))))
+    def extract(data):
+        for needs_processing, walk in address_options:
+            data_chunk = walk(data)
+            # if current address option is not returning missing data, return that data
+            if data_chunk != missing_data_string:
+                return needs_processing, data_chunk
+        # if all address options returned missing data
+        return needs_processing, missing_data_string
+    return extract
+
+def _compile_address_parts(address_parts:list[str]):
+    """Compiles the parts of a single address option into a function walking a response."""
+    steps = []
+    for part_indx, part in enumerate(address_parts):
+        # handle integer address part
+        if part.isdigit():
+            steps.append(_make_index_step(int(part)))
+        # handle * address part
+        elif part == "*":
+            steps.append(_make_list_step(_compile_address_parts(address_parts[part_indx+1:] or [""])))
+            break # do not continue after recursion
+        # handle [] address part
+        elif part.startswith("[") and part.endswith("]"):
+            remaining_parts = address_parts[part_indx+1:]
+            steps.append(_make_concat_step([_compile_address_parts([p] + remaining_parts) for p in part[1:-1].split(",")]))
+            break # do not continue after recursion
+        # handle dictionary keys
+        else:
+            steps.append(_make_key_step(part))
+    def walk(data_chunk):
+        for step in steps:
+            data_chunk, is_done = step(data_chunk)
+            if is_done:
                 break
-            # handle integer address part
-            elif part.isdigit():
-                if isinstance(data_chunk, list):
-                    if len(data_chunk) > int(part):
-                        data_chunk = data_chunk[int(part)]
-                    else:
-                        data_chunk = missing_data_string
-                        break
-                else:
-                    logger.error("Misuse of Integer in Response Address", f"An integer in api addresses should only be used when the preceeding address fragment gives a list, where the index is less than the length of that list. Instead, the preceeding address fragment gave a {type(data_chunk)}.")
-            # handle * address part
-            elif part == "*":
-                if isinstance(data_chunk, list):
-                    new_path = ".".join(address_parts[part_indx+1:])
-                    data_chunk = array_separator.join(
-                        x for d in data_chunk
-                        if (x := str(get_data_by_address(d, new_path)[1])) is not missing_data_string
-                    )
-                    if data_chunk == "":
-                        data_chunk = missing_data_string
-                    break # do not continue after recursion
-                else:
-                    logger.error("Misuse of * in Response Address", f"The * symbol in api addresses should only be used when the preceeding address fragment gives a list. Instead, the preceeding address fragment gave a {type(data_chunk)}.")
-            # handle [] address part
-            elif part.startswith("[") and part.endswith("]"):
-                remaining_address = "." + ".".join(address_parts[part_indx+1:]) if len(address_parts) > part_indx + 1 else ""
-                parts = [p + remaining_address for p in part[1:-1].split(",")]
-                data_chunk = concat_separator.join(
-                    x for p in parts
-                    if (x := str(get_data_by_address(data_chunk, p)[1])) is not missing_data_string
-                )
-                if data_chunk == "":
-                        data_chunk = missing_data_string
-                break # do not continue after recursion
-            # handle dictionary keys
-            else:
-                if part in data_chunk:
-                    data_chunk = data_chunk[part]
-                else:
-                    data_chunk = missing_data_string
-                    break
-        # if current address option is not returning missing data, return that data
-        if data_chunk != missing_data_string:
-            return needs_processing, data_chunk
-    # if all address options returned missing data
-    return needs_processing, missing_data_string
+        return data_chunk
+    return walk
+
+def _make_index_step(indx:int):
+    def step(data_chunk):
+        if not isinstance(data_chunk, list):
+            logger.error("Misuse of Integer in Response Address", f"An integer in api addresses should only be used when the preceeding address fragment gives a list, where the index is less than the length of that list. Instead, the preceeding address fragment gave a {type(data_chunk)}.")
+        if len(data_chunk) > indx:
+            return data_chunk[indx], False
+        return missing_data_string, True
+    return step
+
+def _make_list_step(walk):
+    def step(data_chunk):
+        if not isinstance(data_chunk, list):
+            logger.error("Misuse of * in Response Address", f"The * symbol in api addresses should only be used when the preceeding address fragment gives a list. Instead, the preceeding address fragment gave a {type(data_chunk)}.")
+        data_chunk = array_separator.join(
+            x for d in data_chunk
+            if (x := str(walk(d))) is not missing_data_string
+        )
+        return data_chunk if data_chunk != "" else missing_data_string, True
+    return step
+
+def _make_concat_step(walks:list):
+    def step(data_chunk):
+        data_chunk = concat_separator.join(
+            x for walk in walks
+            if (x := str(walk(data_chunk))) is not missing_data_string
+        )
+        return data_chunk if data_chunk != "" else missing_data_string, True
+    return step
+
+def _make_key_step(key:str):
+    def step(data_chunk):
+        if key in data_chunk:
+            return data_chunk[key], False
+        return missing_data_string, True
+    return step
+
+def compile_header_addresses(api_name:str) -> dict:
+    """Compiles all response addresses for an api, with the root address (\"/\") prepended."""
+    api_header_addresses = header_addresses[api_name].copy()
+    if any(header not in info_headers for header in api_header_addresses if header != "/"):
+        logger.error("Bad Header", f"In settings.json, headers exist for {api_name} that are absent in \"info_headers\".")
+    root_address = (api_header_addresses.pop("/") + ".") if "/" in api_header_addresses else ""
+    return {header: compile_address(root_address + address) for header, address in api_header_addresses.items()}
+
+def get_address_root_keys(api_name:str) -> list[str]:
+    """Returns the top-level response keys that the addresses of an api start from, in order found."""
+    root_keys = []
+    root_address = header_addresses[api_name].get("/")
+    addresses = [root_address] if root_address is not None else header_addresses[api_name].values()
+    for address in addresses:
+        for address_option in address.split("|"):
+            first_part = address_option.split(".", 1)[0].rstrip("@")
+            for key in first_part.strip("[]").split(",") if first_part.startswith("[") else [first_part]:
+                if key not in root_keys:
+                    root_keys.append(key)
+    return root_keys
+
+# compiled response addresses, so that errors in addresses are found when settings are loaded
+compiled_header_addresses = {api_name: compile_header_addresses(api_name) for api_name in ("crossref", "openlibrary", "googlebooks")}
 
 def has_data(data:str) -> bool:
     return data not in ("", missing_data_string)
@@ -484,7 +641,7 @@ def format_id_num_arguments(args:list[str], flag:str="--setcode") -> tuple:
     while i < len(args):
         id_num = args[i]
         if id_num.startswith("--"):
-            logger.error("Unrecognized Flag", f"The flag \"{id_num}\" is not recognized. Only \"--update\", \"--update-all\", \"--setcode\", \"--rename\", and \"--help\" are recognized.")
+            logger.error("Unrecognized Flag", f"The flag \"{id_num}\" is not recognized. Only \"--update\", \"--update-all\", \"--setcode\", \"--rename\", \"--from-file\", \"--rebuild-markdown\", \"--watch\", \"--serve\", \"--isolate-failures\", \"--import-csv\", \"--export-csv\", \"--no-cache\", \"--purge-cache\", and \"--help\" are recognized.")
         id_num_type = get_id_num_type(id_num)
         if id_num_type is None:
             logger.error("Unrecognized Argument", f"The argument {id_num} was expected to be a DOI or an ISBN, but follows the format of neither. DOIs take the form \"10.xxxx/abcd\", whereas ISBNs are just numbers.")
@@ -504,16 +661,24 @@ def get_id_num_type(code:str) -> str|None:
         return "isbn"
     return None
 
-def verify_arguments(arguments:list[str], all_codes:list[str]) -> tuple:
+def verify_arguments(arguments:list[str], get_all_codes) -> tuple:
     update_all_entries = False
     entries_to_update = []
     entries_to_rename = {}
+    run_flags = {"no_cache": False, "purge_cache": False, "rebuild_markdown": False, "watch": False, "serve": False, "isolate_failures": False, "import_csv": False, "export_csv": False, "from_file": None}
     # check for arguments
     if len(arguments) == 0:
         logger.error("No Arguments", "This program requires at least one argument to run")
     if "--help" in arguments:
         print(help_string)
         sys.exit(1)
+    # handle on/off flags
+    for flag in ("--no-cache", "--purge-cache", "--rebuild-markdown", "--watch", "--serve", "--isolate-failures", "--import-csv", "--export-csv"):
+        if flag in arguments:
+            for _ in range(arguments.count(flag)):
+                arguments.pop(arguments.index(flag))
+            run_flags[flag[2:].replace("-", "_")] = True
+            logger.debug(f"The flag {flag} is set")
     # handle --update-all tag
     if "--update-all" in arguments:
         for _ in range(arguments.count("--update-all")):
@@ -524,6 +689,7 @@ def verify_arguments(arguments:list[str], all_codes:list[str]) -> tuple:
         logger.debug("All entries are set to update")
     # handle --update tag
     if "--update" in arguments:
+        all_codes = get_all_codes()
         for _ in range(arguments.count("--update")):
             tag_indx = arguments.index("--update")
             if len(arguments) <= tag_indx + 1:
@@ -538,6 +704,7 @@ def verify_arguments(arguments:list[str], all_codes:list[str]) -> tuple:
         logger.debug(f"The following entries are set to update: {', '.join(entries_to_update)}")
     # handle --rename tag
     if "--rename" in arguments:
+        all_codes = get_all_codes()
         for _ in range(arguments.count("--rename")):
             tag_indx = arguments.index("--rename")
             if len(arguments) <= tag_indx + 2 or \
@@ -556,5 +723,31 @@ def verify_arguments(arguments:list[str], all_codes:list[str]) -> tuple:
             entries_to_rename[old_code] = new_code
             for _ in range(3):
                 arguments.pop(tag_indx) # remove tag, citation code, and new base citation code
+    # handle --from-file tag
+    if "--from-file" in arguments:
+        tag_indx = arguments.index("--from-file")
+        if arguments.count("--from-file") > 1:
+            logger.error("Bad Flag Use", "The \"--from-file\" flag can only be used once")
+        if len(arguments) <= tag_indx + 1 or arguments[tag_indx+1].startswith("--"):
+            logger.error("Bad Flag Use", "The \"--from-file\" flag must be followed by the path of a file of DOIs/ISBNs, or - to read them from stdin")
+        id_file_path = arguments[tag_indx+1]
+        if id_file_path != "-" and not exists(id_file_path):
+            logger.error("File Not Found", f"The file \"{id_file_path}\" given after the \"--from-file\" flag does not exist")
+        run_flags["from_file"] = id_file_path
+        for _ in range(2):
+            arguments.pop(tag_indx) # remove tag and file path
+        logger.debug(f"Entries will be added from {id_file_path}")
     # collect dois and isbns
-    return update_all_entries, entries_to_update, entries_to_rename, format_id_num_arguments(arguments)
+    id_num_arguments = format_id_num_arguments(arguments)
+    for flag in ("--rebuild-markdown", "--watch", "--serve", "--from-file"):
+        if run_flags[flag[2:].replace("-", "_")] and (update_all_entries or entries_to_update or entries_to_rename or id_num_arguments):
+            logger.error("Bad Flag Use", f"The \"{flag}\" flag cannot be used with \"--update-all\", \"--update\", \"--rename\", or DOIs/ISBNs")
+    for flag in ("--import-csv", "--export-csv"):
+        if run_flags[flag[2:].replace("-", "_")] and storage != "sqlite":
+            logger.error("Bad Flag Use", f"The \"{flag}\" flag can only be used when citations_csv.storage in settings.json is \"sqlite\"")
+    if run_flags["watch"] and storage != "csv":
+        logger.error("Bad Flag Use", "The \"--watch\" flag can only be used when citations_csv.storage in settings.json is \"csv\"")
+    # entries of a failed batch are run again one at a time, which must not fetch them all again
+    if run_flags["isolate_failures"] and (run_flags["no_cache"] or not use_cache):
+        logger.error("Bad Flag Use", "The \"--isolate-failures\" flag cannot be used with \"--no-cache\" or when network.use_cache in settings.json is false")
+    return update_all_entries, entries_to_update, entries_to_rename, id_num_arguments, run_flags
@@ -1,33 +1,80 @@
 from aux import logger, hayagriva_file_name, bibtex_file_name, \
     array_separator, concat_separator, \
     read_encoding, write_encoding, \
-    has_data, convert_to_latex
+    has_data, convert_to_latex, check_directory
+from journal import atomic_open
+from snapshot import snapshot
+from mmap import mmap, ACCESS_READ
 import re
-from os.path import exists
+from os.path import exists, getsize, dirname
 
 
 class _Bibliography:
     delim = "\n\n"
     file_name = None
     indent = " " * 2
+    copy_chunk_size = 1024 * 1024
 
     def __init__(self):
-        self.entry_dict, self.backup_entry_dict = {}, {}
+        self.entry_dict = {}        # code: entry text, or None if unchanged and not yet read from file
+        self.entry_spans = {}       # code: (byte offset, byte length) of unchanged entries in the file
+        self.dirty_codes = set()    # codes of entries added or changed since the file was read
+        self.has_removed_entries = False
+        self.file_map = None
         self.citation_class = self.__class__.__name__
         self.citation_file_type = self.citation_class[:-3].lower()
         if self.citation_file_type == "hayagriva":
             self.file_name = hayagriva_file_name
         elif self.citation_file_type == "bibtex":
             self.file_name = bibtex_file_name
+        if self.file_name is not None:
+            check_directory(dirname(self.file_name))
         if self.file_name is not None and exists(self.file_name):
-            logger.debug(f"Reading contents of {self.citation_file_type} file")
-            pattern = r"@[a-z]+?{(.+?),\n" if self.citation_file_type == "bibtex" else r"(.+?):\n"
-            get_code = lambda entry: re.search(pattern, entry).group(1)
-            with open(self.file_name, "r", encoding=read_encoding) as f:
-                file_contents = f.read()
-            if file_contents.strip() != "":
-                self.entry_dict = {get_code(entry): entry for entry in file_contents.split(self.delim)}
-                self.backup_entry_dict = self.entry_dict.copy()
+            saved_entry_spans = snapshot.get(self.citation_file_type, self.file_name)
+            if saved_entry_spans is not None:
+                self._open_file_map()
+                self.entry_dict, self.entry_spans = dict.fromkeys(saved_entry_spans), saved_entry_spans
+            else:
+                logger.debug(f"Indexing contents of {self.citation_file_type} file")
+                self._index_file()
+
+    def _open_file_map(self):
+        if getsize(self.file_name) > 0:
+            with open(self.file_name, "rb") as f:
+                self.file_map = mmap(f.fileno(), 0, access=ACCESS_READ)
+
+    def _index_file(self):
+        """
+        Finds the byte range of every entry in the memory-mapped file, using the line that
+        starts each entry (so blank lines inside entries are allowed). Entry text is only
+        decoded from the file when it is needed.
+        """
+        self.entry_dict, self.entry_spans = {}, {}
+        self._open_file_map()
+        if self.file_map is None:
+            return
+        pattern = rb"^(?:\xef\xbb\xbf)?(?P<entry>@[a-z]+?\{(?P<code>.+?),\r?\n)" if self.citation_file_type == "bibtex" \
+            else rb"^(?:\xef\xbb\xbf)?(?P<entry>(?P<code>[^\s#][^\n]*?):[ \t]*\r?\n)"
+        entry_starts = [(match.start("entry"), match.group("code").decode(read_encoding)) for match in re.finditer(pattern, self.file_map, re.MULTILINE)]
+        for indx, (start, code) in enumerate(entry_starts):
+            end = entry_starts[indx + 1][0] if indx + 1 < len(entry_starts) else len(self.file_map)
+            while end > start and self.file_map[end-1:end].isspace():
+                end -= 1
+            self.entry_dict[code] = None
+            self.entry_spans[code] = (start, end - start)
+        logger.debug(f"Found {len(self.entry_spans)} entries in {self.citation_file_type} file")
+
+    def _get_entry(self, code):
+        text = self.entry_dict[code]
+        if text is None:
+            offset, length = self.entry_spans[code]
+            text = self.file_map[offset:offset + length].decode(read_encoding)
+        return text
+
+    def _close_file_map(self):
+        if self.file_map is not None:
+            self.file_map.close()
+            self.file_map = None
     
     def create_or_update_citation(self, citation_dict):
         if self.file_name is None:
@@ -36,9 +83,11 @@ class _Bibliography:
         new_text = self._get_entry_text(citation_dict).strip()
         if code not in self.entry_dict:
             self.entry_dict[code] = new_text
+            self.dirty_codes.add(code)
             logger.progress(f"Added {code} to {self.citation_file_type} file")
-        elif self.entry_dict[code] != new_text:
+        elif self._get_entry(code) != new_text:
             self.entry_dict[code] = new_text
+            self.dirty_codes.add(code)
             logger.progress(f"Updated entry for {code} in {self.citation_file_type} file")
         else:
             logger.debug(f"No changes detected in {code} citation in {self.citation_file_type} file, no update made")
@@ -53,24 +102,79 @@ class _Bibliography:
                 pop_codes.append(code)
         for code in pop_codes:
             self.entry_dict.pop(code)
+            self.dirty_codes.discard(code)
+            self.has_removed_entries = True
 
     def change_citation_code(self, current_code, new_code):
-        if self.file_name is None:
+        self.change_citation_codes({current_code: new_code})
+
+    def change_citation_codes(self, renamed_codes):
+        """Renames all codes in renamed_codes (old code: new code) in one pass, keeping entry order."""
+        if self.file_name is None or len(renamed_codes) == 0:
             return
         code_func = (lambda code: f"{code}:\n  ") if self.citation_file_type == "hayagriva" else (lambda code: "{" + f"{code},\n")
-        self.entry_dict[new_code] = self.entry_dict[current_code].replace(code_func(current_code), code_func(new_code))
-        self.entry_dict.pop(current_code)
-        logger.progress(f"Changed {current_code} to {new_code} in {self.citation_file_type} file")
+        new_entry_dict = {}
+        for code, text in self.entry_dict.items():
+            if code in renamed_codes:
+                new_code = renamed_codes[code]
+                new_entry_dict[new_code] = self._get_entry(code).replace(code_func(code), code_func(new_code))
+                self.dirty_codes.discard(code)
+                self.dirty_codes.add(new_code)
+                logger.progress(f"Changed {code} to {new_code} in {self.citation_file_type} file")
+            else:
+                new_entry_dict[code] = text
+        self.entry_dict = new_entry_dict
 
-    def save_file(self, revert_to_old=False):
+    def save_snapshot(self):
+        """Saves the entry index in the snapshot. Only valid right after save_file."""
         if self.file_name is None:
             return
-        current_entries = (self.backup_entry_dict if revert_to_old else self.entry_dict)
-        if len(current_entries) > 0:
-            with open(self.file_name, "w", encoding=write_encoding) as f:
-                logger.debug(f"Writing {self.citation_file_type} file")
-                file_contents = self.delim.join(current_entries.values())
-                f.write(file_contents)
+        snapshot.set(self.citation_file_type, self.file_name, self.entry_spans)
+
+    def save_file(self):
+        if self.file_name is None:
+            return
+        if len(self.dirty_codes) == 0 and not self.has_removed_entries:
+            logger.debug(f"No changes made to {self.citation_file_type} file, so it is not rewritten")
+            return
+        if len(self.entry_dict) > 0:
+            logger.debug(f"Writing {len(self.dirty_codes)} changed entries to {self.citation_file_type} file, copying all others")
+            self._write_entries()
+            self._index_file()
+        self.dirty_codes.clear()
+        self.has_removed_entries = False
+
+    def _write_entries(self):
+        """
+        Writes all entries in order, copying unchanged entries from the current file by 
+        byte range (merging neighboring ranges) and encoding only added or changed entries.
+        """
+        delim = self.delim.encode(write_encoding)
+        pieces = [] # [start, end] byte ranges of the current file, or encoded entries
+        for code, text in self.entry_dict.items():
+            if code in self.entry_spans and code not in self.dirty_codes:
+                offset, length = self.entry_spans[code]
+                if len(pieces) > 0 and isinstance(pieces[-1], list) and pieces[-1][1] + len(delim) == offset:
+                    pieces[-1][1] = offset + length
+                else:
+                    pieces.append([offset, offset + length])
+            else:
+                encoded_text = text.encode(write_encoding)
+                pieces.append(encoded_text)
+        with atomic_open(self.file_name, "wb") as f:
+            for indx, piece in enumerate(pieces):
+                if indx > 0:
+                    f.write(delim)
+                if isinstance(piece, list):
+                    self._copy_range(f, *piece)
+                else:
+                    f.write(piece)
+            # the old file is replaced once written, so it can no longer be mapped
+            self._close_file_map()
+
+    def _copy_range(self, destination, start, end):
+        for chunk_start in range(start, end, self.copy_chunk_size):
+            destination.write(self.file_map[chunk_start:min(chunk_start + self.copy_chunk_size, end)])
 
     def _get_entry_text(self, citation_dict):
         logger.error("Not Implemented Error", f"The class {self.citation_class} does not have an implementation of the method _get_entry_text")
@@ -0,0 +1,106 @@
+from aux import logger, response_cache_file_name, use_cache, cache_ttl_days, cache_max_entries, check_directory
+from os.path import dirname
+from threading import Lock
+from time import time
+import sqlite3
+import json
+
+
+class ResponseCache:
+    """
+    Stores the raw json responses of the apis on disk in an sqlite database, keyed
+    by api name (crossref, openlibrary, googlebooks) and DOI/ISBN. Responses holding only
+    some fields of the full record are stored with a string naming those fields.
+    """
+    schema_version = 1
+    def __init__(self, file_name, enabled=True, ttl_days=None, max_entries=None):
+        self.file_name = file_name
+        self.enabled = enabled and file_name is not None
+        self.ttl_seconds = ttl_days * 24 * 60 * 60 if ttl_days is not None else None
+        self.max_entries = max_entries
+        self.connection = None
+        self.lock = Lock()
+
+    def _connect(self):
+        if self.connection is None:
+            check_directory(dirname(self.file_name))
+            logger.debug(f"Opening api response cache {self.file_name}")
+            self.connection = sqlite3.connect(self.file_name, check_same_thread=False, isolation_level=None)
+            if self.connection.execute("PRAGMA user_version").fetchone()[0] != self.schema_version:
+                logger.debug("Api response cache is from an older version, clearing it")
+                self.connection.execute("DROP TABLE IF EXISTS responses")
+                self.connection.execute(f"PRAGMA user_version = {self.schema_version}")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "api_name TEXT NOT NULL, id_num TEXT NOT NULL, payload TEXT NOT NULL, fetched_at REAL NOT NULL, fields TEXT, "
+                "PRIMARY KEY (api_name, id_num))"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_fetched_at ON responses (fetched_at)")
+        return self.connection
+
+    def disable(self):
+        logger.debug("Api response cache disabled for this run")
+        self.enabled = False
+
+    def get(self, api_name, id_num, accepted_fields=()):
+        """Returns the cached response, if it is the full record or holds one of the accepted sets of fields."""
+        if not self.enabled:
+            return None
+        with self.lock:
+            row = self._connect().execute(
+                "SELECT payload, fetched_at, fields FROM responses WHERE api_name = ? AND id_num = ?", (api_name, id_num)
+            ).fetchone()
+        if row is None:
+            return None
+        payload, fetched_at, payload_fields = row
+        if payload_fields is not None and payload_fields not in accepted_fields:
+            logger.debug(f"Cached {api_name} response for \"{id_num}\" is missing fields now in use")
+            return None
+        if self.ttl_seconds is not None and time() - fetched_at > self.ttl_seconds:
+            logger.debug(f"Cached {api_name} response for \"{id_num}\" has expired")
+            return None
+        return json.loads(payload)
+
+    def set(self, api_name, id_num, response, fields=None):
+        if not self.enabled:
+            return
+        with self.lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO responses (api_name, id_num, payload, fetched_at, fields) VALUES (?, ?, ?, ?, ?)",
+                (api_name, id_num, json.dumps(response), time(), fields)
+            )
+
+    def purge(self):
+        if self.file_name is None:
+            return
+        with self.lock:
+            deleted_count = self._connect().execute("DELETE FROM responses").rowcount
+            self.connection.execute("VACUUM")
+        logger.progress(f"Deleted {deleted_count} cached api responses")
+
+    def evict(self):
+        if self.connection is None:
+            return
+        with self.lock:
+            deleted_count = 0
+            if self.ttl_seconds is not None:
+                deleted_count += self.connection.execute(
+                    "DELETE FROM responses WHERE fetched_at < ?", (time() - self.ttl_seconds,)
+                ).rowcount
+            if self.max_entries is not None:
+                deleted_count += self.connection.execute(
+                    "DELETE FROM responses WHERE rowid IN "
+                    "(SELECT rowid FROM responses ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,)
+                ).rowcount
+        if deleted_count > 0:
+            logger.debug(f"Evicted {deleted_count} cached api responses")
+
+    def close(self):
+        if self.connection is None:
+            return
+        self.evict()
+        with self.lock:
+            self.connection.close()
+            self.connection = None
+
+response_cache = ResponseCache(response_cache_file_name, use_cache, cache_ttl_days, cache_max_entries)
@@ -1,28 +1,105 @@
 from aux import logger, csv_file_name, program_headers, \
     info_headers, read_encoding, write_encoding, \
     array_separator, missing_data_string, \
-    format_base_citation_code, get_citation_code_parts, get_code_suffix_from_int, get_int_from_code_suffix, is_valid_citation_code, has_data
-from os.path import exists
+    format_base_citation_code, get_citation_code_parts, get_code_suffix_from_int, get_int_from_code_suffix, is_valid_citation_code, has_data, \
+    check_directory
+from journal import atomic_open
+from snapshot import snapshot
+from os.path import exists, dirname
 from collections import defaultdict
-from copy import deepcopy
+from collections.abc import MutableMapping
 from datetime import datetime
+from sys import intern
+import zlib
 import csv
 
+class _Row(MutableMapping):
+    """
+    One row of the citations csv, read like a dict but stored as a list of cells in header
+    order. Short cells, which are mostly values repeated across rows such as journal, publisher,
+    and type, are interned, and long abstracts and cited dois are kept zlib-compressed until
+    read. The first change to each cell saves its previous value, so changed rows can be found.
+    """
+    __slots__ = ("header_indexes", "cells", "original_cells")
+    compressed_headers = ("abstract", "cited-dois")
+    compress_length = 256
+    intern_length = 64
+
+    def __init__(self, header_indexes, citation_dict):
+        self.header_indexes = header_indexes # header: position, shared by all rows
+        self.cells = [""] * len(header_indexes)
+        self.original_cells = None # position: cell before the first change, for changed rows
+        for header, cell in citation_dict.items():
+            position = self.header_indexes[header]
+            self.cells[position] = self._pack(header, cell)
+
+    def __getitem__(self, header):
+        cell = self.cells[self.header_indexes[header]]
+        return zlib.decompress(cell).decode("utf-8") if isinstance(cell, bytes) else cell
+
+    def __setitem__(self, header, cell):
+        position = self.header_indexes[header]
+        if self[header] == cell:
+            return
+        if self.original_cells is None:
+            self.original_cells = {}
+        self.original_cells.setdefault(position, self.cells[position])
+        self.cells[position] = self._pack(header, cell)
+
+    def __delitem__(self, header):
+        raise TypeError("Cells of a citations csv row cannot be removed")
+
+    def __iter__(self):
+        return iter(self.header_indexes)
+
+    def __len__(self):
+        return len(self.header_indexes)
+
+    def has_empty_cells(self, headers):
+        # compressed cells are never empty, so no cell needs decompressing
+        return any(self.cells[self.header_indexes[header]] == "" for header in headers)
+
+    def is_changed(self):
+        return self.original_cells is not None
+
+    def clear_changes(self):
+        self.original_cells = None
+
+    def _pack(self, header, cell):
+        if not isinstance(cell, str):
+            return cell
+        if header in self.compressed_headers and len(cell) > self.compress_length:
+            return zlib.compress(cell.encode("utf-8"), 1)
+        return intern(cell) if len(cell) <= self.intern_length else cell
+
+
 class _EntryRow:
     def __init__(self, csv_headers=[]):
         self.row_lst = []
         self.code_dict = {}
         self.base_citation_code_count = defaultdict(int)
+        # citation graph indexes
+        self.graph_dict = {}                        # code: (doi, set of cited dois, isbn)
+        self.doi_code_dict = defaultdict(set)       # doi: codes with that doi
+        self.citing_code_dict = defaultdict(set)    # doi: codes citing that doi
+        self.id_num_code_dict = defaultdict(set)    # lower-cased doi or isbn: codes with it
+        self.has_filled_cells = False               # whether cells were filled in while reading the file
         required_headers = program_headers + info_headers
         if not isinstance(csv_headers, list):
             csv_headers = []
-        self.headers = tuple(required_headers + list(set(csv_headers) - set(required_headers)))
+        # extra headers keep their order in the file, so an unchanged file does not need saving
+        self.headers = tuple(required_headers + [header for header in csv_headers if header not in required_headers])
+        self.header_indexes = {header: position for position, header in enumerate(self.headers)}
+        self.has_new_headers = list(self.headers) != csv_headers  # whether headers differ from the file
+        self.has_new_rows = False                   # whether rows were added since the file was read or saved
 
     def add_from_file(self, citation_dict):
         # handle manually entered dicts
         if not has_data(citation_dict["add-date"]):
             citation_dict["add-date"] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+            self.has_filled_cells = True
         if not has_data(citation_dict["type"]):
+            self.has_filled_cells = True
             if has_data(citation_dict["doi"]):
                 citation_dict["type"] = "article"
             elif has_data(citation_dict["isbn"]):
@@ -44,6 +121,7 @@ class _EntryRow:
             logger.error("Repeat Citation Codes Found", f"Citation code \"{code}\" found multiple times in citations csv file (found at row {self.code_dict[code][0]} and row {row_indx}). Please manually input a unique and valid citation code for the repeat rows.")
         # add to code_dict
         self.code_dict[code] = (row_indx, has_empty_cells)
+        self._index_entry(code)
         # add to base_citation_code_count
         self.base_citation_code_count[base_code] = max(
             get_int_from_code_suffix(code_suffix),
@@ -56,12 +134,13 @@ class _EntryRow:
         self._add_citation_code_suffix(base_citation_code, citation_dict)
         code, row_indx, has_empty_cells = self._add_to_row_lst(citation_dict)
         self.code_dict[code] = (row_indx, has_empty_cells)
+        self._index_entry(code)
+        self.has_new_rows = True
         logger.progress(f"Added citation code {code} to entry, and added entry to citations csv file")
         return citation_dict
     
     def _add_to_row_lst(self, citation_dict):
-        full_dict = {header: "" for header in self.headers}
-        full_dict.update(citation_dict)
+        full_dict = _Row(self.header_indexes, citation_dict)
         self.row_lst.append(full_dict)
         code, row_indx, has_empty_cells = full_dict["citation-code"], len(self.row_lst) - 1, self.has_empty_program_cells(full_dict)
         return code, row_indx, has_empty_cells
@@ -77,15 +156,17 @@ class _EntryRow:
             citation_dict = self[code]
         else:
             citation_dict = code_or_dict
-        return any(citation_dict[header] == "" for header in info_headers)
+        return citation_dict.has_empty_cells(info_headers)
 
     def change_citation_code(self, current_code, new_base_code):
         logger.debug(f"Changing citation code {current_code} to have base code of {new_base_code}")
         citation_dict = self[current_code]
         self._add_citation_code_suffix(new_base_code, citation_dict, new_code=True)
         new_code = citation_dict["citation-code"]
+        self._unindex_entry(current_code)
         self.code_dict[new_code] = self.code_dict[current_code]
         self.code_dict.pop(current_code)
+        self._index_entry(new_code)
         logger.progress(f"Citation code {current_code} changed to {new_code} in citations csv")
         return new_code
     
@@ -97,8 +178,33 @@ class _EntryRow:
                     citation_dict[header] = missing_data_string
             logger.debug(f"Filling empty cells of {code} in citations csv")
 
-    def get_rows(self, copy=False):
-        return deepcopy(self.row_lst) if copy else self.row_lst
+    def get_rows(self):
+        return self.row_lst
+
+    def has_changes(self):
+        return self.has_new_headers or self.has_new_rows or self.has_filled_cells or any(row.is_changed() for row in self.row_lst)
+
+    def match_saved_rows(self):
+        """
+        Brings the rows and indexes to the state that parsing the saved csv would give: cells
+        as strings, codes in row order, current empty cell flags, and suffix counts of current codes.
+        Also clears the changes made since the file was read.
+        """
+        self.code_dict = {}
+        self.base_citation_code_count = defaultdict(int)
+        self.has_new_headers = self.has_new_rows = self.has_filled_cells = False
+        for row_indx, citation_dict in enumerate(self.row_lst):
+            for header, cell in citation_dict.items():
+                if not isinstance(cell, str):
+                    citation_dict[header] = "" if cell is None else str(cell)
+            citation_dict.clear_changes()
+            code = citation_dict["citation-code"]
+            self.code_dict[code] = (row_indx, self.has_empty_program_cells(citation_dict))
+            base_code, code_suffix = get_citation_code_parts(code)
+            self.base_citation_code_count[base_code] = max(
+                get_int_from_code_suffix(code_suffix),
+                self.base_citation_code_count[base_code]
+            )
     
     def get_headers(self):
         return self.headers
@@ -118,27 +224,51 @@ class _EntryRow:
         return id_nums
     
     def get_codes_that_cite_code(self, code):
-        code_lst = []
         id_num = self[code]["doi"]
-        if not has_data(id_num):
+        citing_codes = self.citing_code_dict.get(id_num)
+        if not has_data(id_num) or not citing_codes:
             return None
-        for row_dict in self.row_lst:
-            code, cited_dois = row_dict["citation-code"], row_dict["cited-dois"]
-            if has_data(cited_dois) and id_num in cited_dois.split(array_separator):
-                code_lst.append(code)
-        return code_lst if len(code_lst) > 0 else None
+        return sorted(citing_codes, key=lambda citing_code: self.code_dict[citing_code][0])
     
     def get_codes_cited_by_code(self, code):
-        code_lst = []
-        cited_dois = self[code]["cited-dois"]
-        if not has_data(cited_dois):
-            return None
-        cited_dois = cited_dois.split(array_separator)
-        for row_dict in self.row_lst:
-            code, id_num = row_dict["citation-code"], row_dict["doi"]
-            if id_num in cited_dois:
-                code_lst.append(code)
-        return sorted(code_lst) if len(code_lst) > 0 else None
+        self._check_code_exists(code)
+        code_lst = [cited_code for id_num in self.graph_dict[code][1] for cited_code in self.doi_code_dict.get(id_num, ())]
+        return sorted(set(code_lst)) if len(code_lst) > 0 else None
+
+    def find_codes_by_id_num(self, id_num, id_num_type):
+        codes = self.id_num_code_dict.get(id_num.lower(), ())
+        return sorted(
+            (code for code in codes if self[code][id_num_type].lower() == id_num.lower()),
+            key=lambda code: self.code_dict[code][0]
+        )
+
+    def reindex_entry(self, code):
+        """Updates the citation graph indexes after the doi or cited-dois of an entry changes."""
+        self._unindex_entry(code)
+        self._index_entry(code)
+
+    def _index_entry(self, code):
+        citation_dict = self[code]
+        id_num, isbn, cited_dois = citation_dict["doi"], citation_dict["isbn"], citation_dict["cited-dois"]
+        # cited dois are interned, since the same doi is often cited by many entries
+        cited_dois = set(map(intern, cited_dois.split(array_separator))) if has_data(cited_dois) else set()
+        if has_data(id_num):
+            self.doi_code_dict[id_num].add(code)
+        for lookup_id_num in (id_num, isbn):
+            if has_data(lookup_id_num):
+                self.id_num_code_dict[lookup_id_num.lower()].add(code)
+        for cited_doi in cited_dois:
+            self.citing_code_dict[cited_doi].add(code)
+        self.graph_dict[code] = (id_num, cited_dois, isbn)
+
+    def _unindex_entry(self, code):
+        id_num, cited_dois, isbn = self.graph_dict.pop(code)
+        self.doi_code_dict[id_num].discard(code)
+        for lookup_id_num in (id_num, isbn):
+            if has_data(lookup_id_num):
+                self.id_num_code_dict[lookup_id_num.lower()].discard(code)
+        for cited_doi in cited_dois:
+            self.citing_code_dict[cited_doi].discard(code)
 
     def _add_citation_code_suffix(self, base_code, citation_dict, new_code=True):
         self.base_citation_code_count[base_code] += 1
@@ -152,12 +282,14 @@ class _EntryRow:
 
 
 class CSV:
-    old_entries_copy = None
-
     def __init__(self):
         logger.debug("Creating new CSV object")
         self.file_name = csv_file_name
-        if not exists(self.file_name):
+        check_directory(dirname(self.file_name))
+        saved_entry_rows = snapshot.get("csv", self.file_name)
+        if saved_entry_rows is not None:
+            self.entry_rows = saved_entry_rows
+        elif not exists(self.file_name):
             logger.debug("No citations csv file found. New file will be created with new entries.")
             self.entry_rows = _EntryRow()
         else:
@@ -169,26 +301,30 @@ class CSV:
                 for entry in reader:
                     if any(value != "" for value in entry.values()):
                         self.entry_rows.add_from_file(entry)
-            # collect entries in file
-            logger.debug("Reading and collecting entries of citations csv file")
-            self.old_entries_copy = self.entry_rows.get_rows(copy=True)
         self.all_headers = self.entry_rows.get_headers()
     
     def add_from_api(self, citation_dict):
         return self.entry_rows.add_from_api(citation_dict)
 
-    def save_file(self, revert_to_old=False):
+    def save_file(self):
         current_rows = self.entry_rows.get_rows()
-        if (revert_to_old and self.old_entries_copy is None) or len(current_rows) == 0:
+        if len(current_rows) == 0:
             return
-        with open(csv_file_name, "w", encoding=write_encoding, newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=self.all_headers)
-            writer.writeheader()
-            writer.writerows(
-                self.old_entries_copy
-                if revert_to_old
-                else current_rows
-            )
+        if exists(self.file_name) and not self.entry_rows.has_changes():
+            logger.debug("No entries changed, so the citations csv is not saved")
+            return
+        with atomic_open(self.file_name, "w", encoding=write_encoding, newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(self.all_headers)
+            writer.writerows(row.values() for row in current_rows)
+
+    def close(self):
+        pass # the file is only open while it is read or saved
+
+    def save_snapshot(self):
+        """Saves the parsed state of the csv in the snapshot. Only valid right after save_file."""
+        self.entry_rows.match_saved_rows()
+        snapshot.set("csv", self.file_name, self.entry_rows)
 
     def get_entry(self, citation_code):
         return self.entry_rows[citation_code]
@@ -199,6 +335,7 @@ class CSV:
             for header, cell in old_citation_dict.items():
                 if cell == "":
                     old_citation_dict[header] = new_citation_dict[header]
+            self.entry_rows.reindex_entry(citation_code)
             logger.progress(f"Updated missing data in {citation_code} in citations csv file")
         else:
             logger.debug(f"No missing data found in {citation_code}")
@@ -218,8 +355,19 @@ class CSV:
     def change_citation_code(self,current_code, new_base_code):
         return self.entry_rows.change_citation_code(current_code, new_base_code)
     
+    def change_citation_codes(self, new_base_codes):
+        """Renames each code in new_base_codes (code: new base code), returning {old code: new code}."""
+        return {
+            current_code: self.entry_rows.change_citation_code(current_code, new_base_code)
+            for current_code, new_base_code in new_base_codes.items()
+        }
+    
     def get_codes_that_cite_code(self, code):
         return self.entry_rows.get_codes_that_cite_code(code)
     
     def get_codes_cited_by_code(self, code):
         return self.entry_rows.get_codes_cited_by_code(code)
+
+    def find_codes_by_id_num(self, id_num, id_num_type):
+        """Returns the codes of entries with the given doi or isbn (ignoring case), in row order."""
+        return self.entry_rows.find_codes_by_id_num(id_num, id_num_type)
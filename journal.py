@@ -0,0 +1,210 @@
+from aux import logger, journal_dir_name
+from contextlib import contextmanager
+from threading import RLock
+from shutil import copy2, copymode
+from os import chmod, fsync, listdir, makedirs, remove, rename, replace
+from os.path import join, abspath, dirname, basename, exists
+from tempfile import mkstemp
+from uuid import uuid4
+import sqlite3
+import json
+try:
+    import fcntl
+except ImportError: # windows
+    fcntl = None
+    import msvcrt
+
+
+class Journal:
+    """
+    On-disk undo journal for every file this program changes. Before a file is first
+    changed in a run, a copy of it (or a note that it did not exist) is saved in the
+    journal folder, so the run can be rolled back even after the program is killed.
+    Database connections added with add_connection are committed and rolled back with
+    the files, so their changes are kept only if the files are. Before they are committed,
+    the commit is noted in the journal and in each database, so that a run killed partway
+    through committing is recovered to the same side for both.
+    """
+    manifest_name = "manifest.jsonl"
+    lock_name = "lock"
+
+    def __init__(self, dir_name):
+        self.dir_name = dir_name
+        self.manifest_path = join(dir_name, self.manifest_name)
+        self.lock_file = None
+        self.recorded_paths = set()
+        self.connections = []
+        self.lock = RLock()
+
+    def acquire(self):
+        """
+        Locks the journal for this process until it exits, so that another run (such as a
+        --serve or --watch left running) never has its files saved over or rolled back.
+        """
+        makedirs(self.dir_name, exist_ok=True)
+        self.lock_file = open(join(self.dir_name, self.lock_name), "a+")
+        self.lock_file.seek(0)
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            self.lock_file.close()
+            self.lock_file = None
+            logger.error("Program Already Running", f"Another run of this program is using the files of {dirname(self.dir_name)}. Wait for it to finish (or stop it, if it is running with --serve or --watch) and try again.")
+
+    def record(self, file_path):
+        """Saves the current state of file_path in the journal if not already saved this run."""
+        file_path = abspath(file_path)
+        with self.lock:
+            if file_path in self.recorded_paths:
+                return
+            makedirs(self.dir_name, exist_ok=True)
+            backup_name = None
+            if exists(file_path):
+                backup_name = f"{len(self.recorded_paths)}.bak"
+                copy2(file_path, join(self.dir_name, backup_name))
+                _fsync_path(join(self.dir_name, backup_name))
+            self._write_record({"path": file_path, "backup": backup_name})
+            self.recorded_paths.add(file_path)
+
+    def add_connection(self, connection):
+        """Adds an sqlite connection, which must not have uncommitted changes yet."""
+        with self.lock:
+            if connection not in self.connections:
+                connection.execute("CREATE TABLE IF NOT EXISTS journal_commit (commit_id TEXT NOT NULL)")
+                connection.commit()
+                self.connections.append(connection)
+
+    def remove_connection(self, connection):
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+
+    def is_pending(self):
+        return exists(self.manifest_path)
+
+    def recover(self):
+        """Restores all files if a previous run was interrupted before finishing."""
+        if not self.is_pending():
+            return
+        commit_records = [record for record in self._read_records() if "commit" in record]
+        if len(commit_records) > 0 and all(
+            _get_commit_id(database_path) == commit_records[-1]["commit"] for database_path in commit_records[-1]["databases"]
+        ):
+            logger.progress("A previous run was interrupted after saving all files. Keeping its changes.")
+            self._clear()
+        else:
+            logger.progress("A previous run did not finish. Restoring files to how they were before that run.")
+            self.rollback()
+
+    def rollback(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.rollback()
+            if self.is_pending():
+                logger.debug("Rolling back all files changed in this run")
+                for record in reversed(self._read_records()):
+                    if "path" not in record:
+                        continue # commit record, the databases were rolled back above
+                    file_path, backup_name = record["path"], record["backup"]
+                    if backup_name is None:
+                        if exists(file_path):
+                            remove(file_path)
+                    elif exists(join(self.dir_name, backup_name)):
+                        replace(join(self.dir_name, backup_name), file_path)
+            self._clear()
+
+    def commit(self):
+        with self.lock:
+            changed_connections = [connection for connection in self.connections if connection.in_transaction]
+            if len(changed_connections) > 0:
+                commit_id = uuid4().hex
+                for connection in changed_connections:
+                    connection.execute("DELETE FROM journal_commit")
+                    connection.execute("INSERT INTO journal_commit (commit_id) VALUES (?)", (commit_id,))
+                self._write_record({"commit": commit_id, "databases": [_get_database_path(connection) for connection in changed_connections]})
+                for connection in changed_connections:
+                    connection.commit()
+            if self.is_pending():
+                logger.debug("All files saved, clearing journal")
+            self._clear()
+
+    def _write_record(self, record):
+        makedirs(self.dir_name, exist_ok=True)
+        with open(self.manifest_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            fsync(f.fileno())
+
+    def _read_records(self):
+        records = []
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            for line in f.read().splitlines():
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue # partially written final line, nothing was changed after it yet
+        return records
+
+    def _clear(self):
+        # the lock file is kept, since this process still holds it
+        if exists(self.dir_name):
+            for file_name in listdir(self.dir_name):
+                if file_name != self.lock_name:
+                    remove(join(self.dir_name, file_name))
+        self.recorded_paths.clear()
+
+def _get_database_path(connection):
+    return connection.execute("PRAGMA database_list").fetchone()[2]
+
+def _get_commit_id(database_path):
+    """Returns the id of the last commit noted in a database, or None."""
+    if not exists(database_path):
+        return None
+    # opening the database also rolls back a commit it did not finish
+    connection = sqlite3.connect(database_path)
+    try:
+        row = connection.execute("SELECT commit_id FROM journal_commit").fetchone()
+    except sqlite3.Error:
+        row = None
+    finally:
+        connection.close()
+    return None if row is None else row[0]
+
+def _fsync_path(file_path):
+    with open(file_path, "rb") as f:
+        fsync(f.fileno())
+
+journal = Journal(journal_dir_name)
+
+# journaled file operations
+@contextmanager
+def atomic_open(file_path, mode="w", encoding=None, newline=None):
+    """Opens a temporary file that replaces file_path only once it is completely written."""
+    journal.record(file_path)
+    file_descriptor, temp_path = mkstemp(dir=dirname(abspath(file_path)), prefix="." + basename(file_path), suffix=".tmp")
+    try:
+        with open(file_descriptor, mode, encoding=encoding, newline=newline) as f:
+            yield f
+            f.flush()
+            fsync(f.fileno())
+        if exists(file_path):
+            copymode(file_path, temp_path)
+        else:
+            chmod(temp_path, 0o644)
+        replace(temp_path, file_path)
+    except BaseException:
+        if exists(temp_path):
+            remove(temp_path)
+        raise
+
+def remove_file(file_path):
+    journal.record(file_path)
+    remove(file_path)
+
+def rename_file(old_file_path, new_file_path):
+    journal.record(old_file_path)
+    journal.record(new_file_path)
+    rename(old_file_path, new_file_path)
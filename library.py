@@ -0,0 +1,493 @@
+from aux import logger, has_data, storage, csv_file_name, watch_poll_interval, watch_debounce, CommandCiteError, \
+    checkpoint_file_name, retry_file_name, import_chunk_size, read_encoding, format_id_num_arguments
+from os.path import abspath, exists
+from itertools import islice
+from hashlib import blake2b
+from time import sleep
+import shlex
+import json
+import sys
+
+
+class Library:
+    """
+    The citations csv, markdown files, bibliography files, and apis managed by this program.
+    Each is only created (and its modules only imported) once an operation needs it.
+    """
+    def __init__(self):
+        self._csv, self._md, self._bibtex, self._hayagriva, self._api = (None,) * 5
+        self._uses_cache = False
+        self.retry_lines = [] # entries skipped by --isolate-failures, as lines for --from-file
+
+    @property
+    def csv(self):
+        if self._csv is None and storage == "sqlite":
+            from sqlite_file import SQLiteCSV
+            self._csv = SQLiteCSV()
+        elif self._csv is None:
+            from csv_file import CSV
+            self._csv = CSV()
+        return self._csv
+
+    @property
+    def md(self):
+        if self._md is None:
+            from md_files import Markdowns
+            self._md = Markdowns()
+        return self._md
+
+    @property
+    def bibtex(self):
+        if self._bibtex is None:
+            from bibliography_files import BibtexBib
+            self._bibtex = BibtexBib()
+        return self._bibtex
+
+    @property
+    def hayagriva(self):
+        if self._hayagriva is None:
+            from bibliography_files import HayagrivaBib
+            self._hayagriva = HayagrivaBib()
+        return self._hayagriva
+
+    @property
+    def api(self):
+        if self._api is None:
+            logger.debug("Loading network modules")
+            from api import CiteWorks
+            self._api = CiteWorks()
+        return self._api
+
+    @property
+    def response_cache(self):
+        from cache import response_cache
+        self._uses_cache = True
+        return response_cache
+
+    def reload(self):
+        """Forgets all loaded files, so they are read again when next needed (the api is kept)."""
+        from snapshot import snapshot
+        if self._csv is not None:
+            self._csv.close()
+        self._csv, self._md, self._bibtex, self._hayagriva = (None,) * 4
+        snapshot.reset()
+
+    def get_all_citation_codes(self):
+        return self.csv.get_all_citation_codes()
+
+    def import_csv(self):
+        """Replaces the entries of the citations database with the rows of the citations csv."""
+        from csv_file import CSV
+        logger.progress("Importing Citations CSV", title_message=True)
+        self.csv.import_csv(CSV())
+        logger.progress_newline()
+
+    def export_csv(self):
+        """Writes the entries of the citations database to the citations csv."""
+        logger.progress("Exporting Citations CSV", title_message=True)
+        self.csv.export_csv()
+        logger.progress_newline()
+
+    def rebuild_markdown(self):
+        logger.progress("Rebuilding Markdown Files", title_message=True)
+        csv = self.csv
+        self.md.rebuild_files([(csv.get_entry(code), csv.get_codes_cited_by_code(code)) for code in csv.get_all_citation_codes()])
+        logger.progress_newline()
+
+    def update_entries(self, entries_to_update, keep_unfetched_empty=False):
+        """
+        Updates the given codes, returning those whose new data could not be fetched. Their
+        empty cells are filled with the missing data string, unless keep_unfetched_empty is
+        set because they are added to the retry file, which updates them again.
+        """
+        logger.progress("Updating Entries", title_message=True)
+        csv, md, bibtex, hayagriva = self.csv, self.md, self.bibtex, self.hayagriva
+        entries_that_need_updating = csv.get_entries_needing_updating()
+        # collect ids needing new data and fetch them all up front
+        requested_id_nums = {}
+        for code in entries_to_update:
+            citation_dict = csv.get_entry(code)
+            if entries_that_need_updating is not None \
+                and code in entries_that_need_updating \
+                and (has_data(citation_dict["doi"]) or has_data(citation_dict["isbn"])):
+                id_num_type = "doi" if has_data(citation_dict["doi"]) else "isbn"
+                requested_id_nums[code] = (citation_dict[id_num_type], id_num_type)
+        fetched_dicts = {}
+        if len(requested_id_nums) > 0:
+            fetched_dicts = dict(zip(requested_id_nums, self.api.get_csv_rows(list(requested_id_nums.values()))))
+        unfetched_codes = []
+        for code in entries_to_update:
+            logger.progress(f"Checking if {code} needs to be updated")
+            # get new citation dict
+            new_dict_requested = code in fetched_dicts
+            new_citation_dict = fetched_dicts.get(code)
+            # update csv
+            if new_dict_requested and new_citation_dict is not None:
+                csv.update_entry(code, new_citation_dict)
+            else:
+                if new_dict_requested:
+                    unfetched_codes.append(code)
+                if not (new_dict_requested and keep_unfetched_empty):
+                    csv.fill_missing_cells(code)
+            new_citation_dict = csv.get_entry(code)
+            # update mds
+            md.create_or_update_file(new_citation_dict, csv.get_codes_cited_by_code(code))
+            # update bibliographies
+            bibtex.create_or_update_citation(new_citation_dict)
+            hayagriva.create_or_update_citation(new_citation_dict)
+            logger.progress_newline()
+        return unfetched_codes
+
+    def rename_entries(self, entries_to_rename):
+        logger.progress("Renaming Entries", title_message=True)
+        csv = self.csv
+        cited_by_dict = {code: csv.get_codes_that_cite_code(code) for code in entries_to_rename}
+        # change codes in csv
+        renamed_codes = csv.change_citation_codes(entries_to_rename)
+        # change codes in md, touching each file once
+        self.md.change_citation_codes(renamed_codes, cited_by_dict)
+        # change codes in bibliographies
+        self.bibtex.change_citation_codes(renamed_codes)
+        self.hayagriva.change_citation_codes(renamed_codes)
+        logger.progress_newline()
+        return renamed_codes
+
+    def add_entries(self, entry_infos):
+        """Adds the given entries, returning the codes added and the entry infos that could not be fetched."""
+        logger.progress("Creating New Entries", title_message=True)
+        csv, md, bibtex, hayagriva = self.csv, self.md, self.bibtex, self.hayagriva
+        existing_codes = csv.get_all_id_nums()
+        # fetch all new ids up front, then add them in the order given
+        entries_to_fetch = []
+        for entry_info in entry_infos:
+            id_num, id_num_type = entry_info[:2]
+            if id_num in existing_codes[id_num_type]:
+                logger.progress(f"The {id_num_type} \"{id_num}\" is already found in the citations csv. Skipping.")
+                logger.progress_newline()
+                continue
+            if any(id_num == entry_to_fetch[0] for entry_to_fetch in entries_to_fetch):
+                logger.progress(f"The {id_num_type} \"{id_num}\" is given more than once. Skipping.")
+                logger.progress_newline()
+                continue
+            entries_to_fetch.append(entry_info)
+        added_codes, unfetched_entry_infos = [], []
+        if len(entries_to_fetch) == 0:
+            return added_codes, unfetched_entry_infos
+        dirty_citing_codes = {} # codes of md files citing new entries, in order found
+        for entry_info, citation_dict in zip(entries_to_fetch, self.api.get_csv_rows(entries_to_fetch)):
+            if citation_dict is None:
+                unfetched_entry_infos.append(entry_info)
+            else:
+                # add to csv
+                citation_dict = csv.add_from_api(citation_dict)
+                # add md file
+                code = citation_dict["citation-code"]
+                added_codes.append(code)
+                md.create_or_update_file(citation_dict, csv.get_codes_cited_by_code(code))
+                code_lst = csv.get_codes_that_cite_code(code)
+                if code_lst is not None:
+                    dirty_citing_codes.update(dict.fromkeys(code_lst))
+                # add bibliography entries
+                bibtex.create_or_update_citation(citation_dict)
+                hayagriva.create_or_update_citation(citation_dict)
+            logger.progress_newline()
+        # update md files citing new entries once, after all entries are added
+        for citing_code in dirty_citing_codes:
+            md.create_or_update_file(
+                csv.get_entry(citing_code),
+                csv.get_codes_cited_by_code(citing_code)
+            )
+        return added_codes, unfetched_entry_infos
+
+    def watch(self):
+        """
+        Keeps the markdown and bibliography files matched to the citations csv, applying the rows
+        that changed each time the csv is saved, until interrupted. Does not use the network.
+        """
+        from snapshot import get_source_key
+        from journal import journal
+        # read all files before watching, so changes are compared against the current csv
+        self.csv, self.md, self.bibtex, self.hayagriva
+        source_key = get_source_key(csv_file_name)
+        logger.progress(f"Watching {csv_file_name} for changes (press Ctrl+C to stop)", title_message=True)
+        logger.progress_newline()
+        try:
+            while True:
+                sleep(watch_poll_interval)
+                if get_source_key(csv_file_name) == source_key:
+                    continue
+                # wait for the file to stop changing, so several quick saves are applied together
+                source_key = get_source_key(csv_file_name)
+                while True:
+                    sleep(watch_debounce)
+                    new_source_key = get_source_key(csv_file_name)
+                    if new_source_key == source_key:
+                        break
+                    source_key = new_source_key
+                previous_csv = self.csv
+                try:
+                    if self._apply_csv_changes():
+                        journal.commit()
+                except BaseException as e:
+                    # undo the partly applied changes, and keep comparing against the csv the
+                    # restored files match, so the failed changes are applied with the next edit
+                    journal.rollback()
+                    self.reload()
+                    self._csv = previous_csv
+                    if isinstance(e, KeyboardInterrupt):
+                        raise
+                    if not isinstance(e, CommandCiteError):
+                        logger.progress(f"Changes could not be applied ({type(e).__name__}: {e})")
+                        logger.progress_newline()
+                source_key = get_source_key(csv_file_name)
+        except KeyboardInterrupt:
+            logger.progress("Stopped watching", title_message=True)
+            logger.progress_newline()
+
+    def _apply_csv_changes(self):
+        """
+        Reads the citations csv again and updates the files of changed, added, and removed entries.
+        Returns False, keeping the previous state, if the csv cannot be read.
+        """
+        from csv_file import CSV
+        try:
+            new_csv = CSV()
+        except Exception as e:
+            if not isinstance(e, CommandCiteError):
+                logger.progress(f"The citations csv could not be read ({type(e).__name__}: {e})")
+            logger.progress("Keeping previous files until the citations csv is fixed")
+            logger.progress_newline()
+            return False
+        old_csv = self.csv
+        old_codes, new_codes = set(old_csv.get_all_citation_codes()), new_csv.get_all_citation_codes()
+        changed_codes = [code for code in new_codes if code not in old_codes or old_csv.get_entry(code) != new_csv.get_entry(code)]
+        removed_codes = old_codes - set(new_codes)
+        if len(changed_codes) == 0 and len(removed_codes) == 0:
+            logger.debug("Citations csv changed on disk but no entries changed")
+            self._csv = new_csv
+            return False
+        logger.progress("Applying Changes to Citations CSV", title_message=True)
+        # entries citing a changed entry, before or after the change, need their links updated
+        dirty_codes = dict.fromkeys(changed_codes)
+        for csv in (old_csv, new_csv):
+            for code in set(changed_codes).union(removed_codes):
+                if code in csv.get_all_citation_codes():
+                    dirty_codes.update(dict.fromkeys(csv.get_codes_that_cite_code(code) or ()))
+        self._csv = new_csv
+        md, bibtex, hayagriva = self.md, self.bibtex, self.hayagriva
+        for code in dirty_codes:
+            if code not in new_codes:
+                continue
+            citation_dict = new_csv.get_entry(code)
+            md.create_or_update_file(citation_dict, new_csv.get_codes_cited_by_code(code))
+            if code in changed_codes:
+                logger.progress(f"Updated files of {code}")
+                bibtex.create_or_update_citation(citation_dict)
+                hayagriva.create_or_update_citation(citation_dict)
+        for code in removed_codes:
+            logger.progress(f"Removed files of {code}")
+        logger.progress_newline()
+        # the csv the user is editing is only rewritten if cells were filled in while reading it
+        self.save()
+        return True
+
+    def import_entries(self, id_file_path, isolate_failures=False):
+        """
+        Adds the DOIs/ISBNs listed one per line in a file (or stdin for "-"), committing every
+        import_chunk_size lines along with a checkpoint of the lines done. Running the same
+        import again after an interruption continues after the last committed line, if the
+        lines before it are unchanged. Lines of the form "--update [citation-code]" update
+        that entry instead, as in a retry file.
+        """
+        from journal import atomic_open, remove_file
+        source = id_file_path if id_file_path == "-" else abspath(id_file_path)
+        checkpoint = None
+        if exists(checkpoint_file_name):
+            with open(checkpoint_file_name, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            if checkpoint["source"] != source:
+                logger.progress(f"Discarding the unfinished import of {checkpoint['source']} to import {id_file_path}")
+                logger.progress_newline()
+                checkpoint = None
+        lines_done, lines_hash = 0, blake2b(digest_size=16)
+
+        def commit_chunk(entries, line_num, is_last):
+            def save_checkpoint():
+                if not is_last:
+                    with atomic_open(checkpoint_file_name, "w", encoding="utf-8") as f:
+                        json.dump({"source": source, "lines_done": line_num, "lines_hash": lines_hash.hexdigest(), "retry_lines": self.retry_lines}, f)
+                elif exists(checkpoint_file_name):
+                    remove_file(checkpoint_file_name)
+            self._commit_entries(entries, isolate_failures, save_checkpoint)
+            logger.progress(f"Imported {line_num} lines of {id_file_path}")
+            logger.progress_newline()
+
+        id_file = sys.stdin if id_file_path == "-" else open(id_file_path, "r", encoding=read_encoding)
+        try:
+            if checkpoint is not None:
+                # the checkpoint only applies if the lines it covers are the same as before
+                for line in islice(id_file, checkpoint["lines_done"]):
+                    lines_hash.update(line.encode("utf-8"))
+                if lines_hash.hexdigest() == checkpoint.get("lines_hash"):
+                    lines_done = checkpoint["lines_done"]
+                    self.retry_lines.extend(checkpoint["retry_lines"])
+                    logger.progress(f"Continuing the import of {id_file_path} after line {lines_done}")
+                elif id_file is sys.stdin:
+                    logger.error("Unfinished Import Does Not Match", f"The first {checkpoint['lines_done']} lines read from stdin are not those of the unfinished import. Give the same lines to continue it, or delete {checkpoint_file_name} to start a new import.")
+                else:
+                    logger.progress(f"{id_file_path} changed since the unfinished import, so it is imported from the start")
+                    id_file.seek(0)
+                    lines_hash = blake2b(digest_size=16)
+                logger.progress_newline()
+            entries, line_num = [], lines_done
+            for line_num, line in enumerate(id_file, start=lines_done + 1):
+                lines_hash.update(line.encode("utf-8"))
+                arguments = shlex.split(line, comments=True)
+                if len(arguments) > 0:
+                    try:
+                        entries.extend(_get_import_entries(arguments))
+                    except CommandCiteError:
+                        if not isolate_failures:
+                            raise
+                        logger.progress(f"Skipping line {line_num} of {id_file_path}")
+                        self.retry_lines.append(line.strip())
+                if line_num % import_chunk_size == 0:
+                    commit_chunk(entries, line_num, is_last=False)
+                    entries = []
+            commit_chunk(entries, line_num, is_last=True)
+        finally:
+            if id_file is not sys.stdin:
+                id_file.close()
+
+    def run_isolated(self, entries):
+        """
+        Updates or adds entries, given as ("update", citation code) or ("add", entry info) pairs,
+        committing every import_chunk_size entries. Entries that fail are skipped and kept for
+        the retry file, while all others are committed.
+        """
+        for start in range(0, len(entries), import_chunk_size):
+            self._commit_entries(entries[start:start+import_chunk_size], isolate_failures=True)
+
+    def _commit_entries(self, entries, isolate_failures, before_commit=None):
+        """
+        Runs entries as one unit of work, then calls before_commit and commits all files. If
+        isolate_failures is set and the unit fails, it is rolled back and each entry is run as
+        its own unit instead (api responses are cached, so nothing is fetched twice). Entries
+        that could not be fetched are added to the retry file.
+        """
+        from journal import journal
+        retry_line_count = len(self.retry_lines)
+        try:
+            for entry in self._run_entries(entries):
+                self._skip_failed_entry(entry)
+            if before_commit is not None:
+                before_commit()
+            journal.commit()
+            return
+        except Exception as e:
+            journal.rollback()
+            self.reload()
+            del self.retry_lines[retry_line_count:]
+            if not isolate_failures:
+                raise
+            error = e
+        if len(entries) == 1:
+            self._skip_failed_entry(entries[0], error)
+        else:
+            logger.progress(f"Running {len(entries)} entries one at a time to find the failing entries")
+            logger.progress_newline()
+            for entry in entries:
+                try:
+                    for unfetched_entry in self._run_entries([entry]):
+                        self._skip_failed_entry(unfetched_entry)
+                    journal.commit()
+                except Exception as e:
+                    journal.rollback()
+                    self.reload()
+                    self._skip_failed_entry(entry, e)
+        if before_commit is not None:
+            before_commit()
+            journal.commit()
+
+    def _run_entries(self, entries):
+        """Runs and saves entries, returning those that could not be fetched."""
+        codes_to_update = [item for kind, item in entries if kind == "update"]
+        entry_infos = [item for kind, item in entries if kind == "add"]
+        unfetched_entries = []
+        if len(codes_to_update) > 0:
+            unfetched_entries.extend(("update", code) for code in self.update_entries(codes_to_update, keep_unfetched_empty=True))
+        if len(entry_infos) > 0:
+            unfetched_entries.extend(("add", entry_info) for entry_info in self.add_entries(entry_infos)[1])
+        self.save()
+        return unfetched_entries
+
+    def _skip_failed_entry(self, entry, error=None):
+        kind, item = entry
+        if kind == "update":
+            retry_line = f"--update {item}"
+        else:
+            id_num, _, custom_base_code = item
+            retry_line = shlex.quote(id_num) + ("" if custom_base_code is None else f" --setcode {shlex.quote(custom_base_code)}")
+        if error is None:
+            logger.progress(f"Could not fetch \"{retry_line}\"")
+        elif not isinstance(error, CommandCiteError):
+            logger.progress(f">>> ERROR ({type(error).__name__}): {error}")
+        logger.progress(f"Skipping \"{retry_line}\", which is added to the retry file")
+        logger.progress_newline()
+        self.retry_lines.append(retry_line)
+
+    def save_retry_file(self):
+        """Saves the entries skipped by --isolate-failures or --from-file, or removes an old retry file if none were skipped."""
+        from journal import atomic_open, remove_file
+        if len(self.retry_lines) > 0:
+            with atomic_open(retry_file_name, "w", encoding="utf-8") as f:
+                f.write("\n".join(self.retry_lines) + "\n")
+            logger.progress(f"{len(self.retry_lines)} entries failed. To try them again, run: cite --isolate-failures --from-file {retry_file_name}")
+            logger.progress_newline()
+        elif exists(retry_file_name):
+            remove_file(retry_file_name)
+
+    def save(self):
+        """Deletes files and entries missing from the citations csv, then saves all files."""
+        if self._csv is None:
+            logger.debug("Citations csv was not loaded, so no files are saved")
+            return
+        logger.progress("Saving Files", title_message=True)
+        # delete files and entries for missing data
+        citation_code_lst = self.csv.get_all_citation_codes()
+        self.md.delete_unmatched_files(citation_code_lst)
+        self.bibtex.delete_unmatched_citations(citation_code_lst)
+        self.hayagriva.delete_unmatched_citations(citation_code_lst)
+        # save files, with the csv last so that its rows are only saved once all other files are
+        self.bibtex.save_file()
+        self.hayagriva.save_file()
+        self.md.save_manifest()
+        self.csv.save_file()
+        # save parsed state of saved files for the next run
+        from snapshot import snapshot
+        self.csv.save_snapshot()
+        self.bibtex.save_snapshot()
+        self.hayagriva.save_snapshot()
+        self.md.save_snapshot()
+        snapshot.save_file()
+
+    def close(self):
+        """Closes the citations csv, response cache, and network connections, if they were used."""
+        if self._csv is not None:
+            self._csv.close()
+        if self._uses_cache or self._api is not None:
+            from cache import response_cache
+            response_cache.close()
+        if self._api is not None:
+            from network import close_sessions
+            self._api.close()
+            close_sessions()
+
+
+def _get_import_entries(arguments):
+    """Returns the ("update", citation code) or ("add", entry info) pairs for one line of arguments."""
+    if arguments[0] == "--update":
+        if len(arguments) != 2:
+            logger.error("Bad Flag Use", "An \"--update\" line must be followed by exactly one citation code")
+        return [("update", arguments[1])]
+    return [("add", entry_info) for entry_info in format_id_num_arguments(arguments)]
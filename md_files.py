@@ -1,49 +1,96 @@
-from aux import logger, md_dir_name, \
+from aux import logger, settings, md_dir_name, \
     array_separator, concat_separator, \
-    link_cited, delete_unmatched_citations, automate_pdf_link_article, automate_pdf_link_book, included_properties, user_defined_properties, \
+    link_cited, delete_unmatched_citations, automate_pdf_link_article, automate_pdf_link_book, included_properties, user_defined_properties, md_num_workers, \
     read_encoding, write_encoding, \
-    has_data, make_md_link, update_frontmatter
-from os import remove, listdir, rename
+    has_data, make_md_link, update_frontmatter, check_directory
+from journal import atomic_open, remove_file, rename_file
+from snapshot import snapshot
+from os import listdir, stat
 from os.path import join, basename, exists
+from hashlib import blake2b
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import json
+import re
 
 
 class _FileCollection:
     def __init__(self, dir_name):
         self.dir_name = dir_name
-        self.edited_md_files = {"created": [], "code_changed": [], "updated_or_deleted": {}}
         if self.dir_name is not None:
-            self.current_md_files = [path for path in sorted(listdir(self.dir_name)) if path.endswith(".md")]
+            self.current_md_files = snapshot.get("markdown", self.dir_name)
+            if self.current_md_files is None:
+                self.current_md_files = [path for path in sorted(listdir(self.dir_name)) if path.endswith(".md")]
     
     def record_created(self, file_path):
-        self.edited_md_files["created"].append(file_path)
         self.current_md_files.append(basename(file_path))
     
-    def record_code_changed(self, new_file_path, old_file_path, old_content):
-        self.edited_md_files["code_changed"].append([new_file_path, old_file_path, old_content])
+    def record_code_changed(self, new_file_path, old_file_path):
         self.current_md_files[self.current_md_files.index(basename(old_file_path))] = basename(new_file_path)
     
-    def record_updated(self, file_path, file_content, check_created=False):
-        if check_created and file_path in self.edited_md_files["created"]:
-            return
-        if file_path not in self.edited_md_files["updated_or_deleted"]:
-            self.edited_md_files["updated_or_deleted"][file_path] = file_content
-    
-    def record_deleted(self, file_path, file_content):
-        self.record_updated(file_path, file_content)
+    def record_deleted(self, file_path):
         self.current_md_files.pop(self.current_md_files.index(basename(file_path)))
     
-    def get_created_files(self):
-        return self.edited_md_files["created"]
-
-    def get_code_change_files(self):
-        return self.edited_md_files["code_changed"]
-    
-    def get_updated_or_deleted_files(self):
-        return self.edited_md_files["updated_or_deleted"]
-    
     def get_current_md_file_paths(self):
         return self.current_md_files.copy()
 
+class _Manifest:
+    """
+    Sidecar file in the markdown folder recording, for each note, its size and modification
+    time, a hash of its yaml frontmatter, and a hash of the frontmatter last rendered for it.
+    """
+    file_name = ".cite_manifest.json"
+
+    def __init__(self, dir_name):
+        self.file_path = join(dir_name, self.file_name) if dir_name is not None else None
+        self.entries = {}
+        self.has_changed = False
+        # settings used when merging frontmatter are part of the rendered hash
+        self.settings_hash = _get_hash(json.dumps(settings["markdown"], sort_keys=True))
+        if self.file_path is not None and exists(self.file_path):
+            try:
+                with open(self.file_path, "r", encoding=read_encoding) as f:
+                    self.entries = json.load(f)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                logger.debug("Markdown manifest could not be read, all notes will be checked")
+
+    def get_rendered_hash(self, yaml_frontmatter):
+        return _get_hash(self.settings_hash + yaml_frontmatter)
+
+    def is_unchanged(self, code, file_stat, rendered_hash):
+        entry = self.entries.get(code)
+        return entry is not None and entry["rendered_hash"] == rendered_hash \
+            and entry["size"] == file_stat.st_size and entry["mtime_ns"] == file_stat.st_mtime_ns
+
+    def has_same_frontmatter(self, code, yaml_frontmatter, rendered_hash):
+        entry = self.entries.get(code)
+        return entry is not None and entry["rendered_hash"] == rendered_hash \
+            and entry["frontmatter_hash"] == _get_hash(yaml_frontmatter)
+
+    def record(self, code, file_path, yaml_frontmatter, rendered_hash):
+        file_stat = stat(file_path)
+        self.entries[code] = {
+            "size": file_stat.st_size,
+            "mtime_ns": file_stat.st_mtime_ns,
+            "frontmatter_hash": _get_hash(yaml_frontmatter),
+            "rendered_hash": rendered_hash,
+        }
+        self.has_changed = True
+
+    def remove(self, code):
+        if self.entries.pop(code, None) is not None:
+            self.has_changed = True
+
+    def save_file(self):
+        if self.file_path is None or not self.has_changed:
+            return
+        with atomic_open(self.file_path, "w", encoding=write_encoding) as f:
+            json.dump(self.entries, f)
+        self.has_changed = False
+
+def _get_hash(string):
+    return blake2b(string.encode("utf-8"), digest_size=16).hexdigest()
+
 class Markdowns:
     dir_name = md_dir_name
     yaml_separator = "---\n"
@@ -51,8 +98,11 @@ class Markdowns:
     current_md_files = None
 
     def __init__(self):
+        if self.dir_name is not None:
+            check_directory(self.dir_name)
         logger.debug("Getting all markdown file names for Markdowns class")
         self.file_collection = _FileCollection(self.dir_name)
+        self.manifest = _Manifest(self.dir_name)
 
     def create_or_update_file(self, citation_dict, cited_links_lst=None):
         if self.dir_name is None:
@@ -60,24 +110,59 @@ class Markdowns:
         code = citation_dict["citation-code"]
         file_path = self._get_file_path(code)
         new_yaml_frontmatter = self._get_yaml_frontmatter(citation_dict, cited_links_lst)
+        rendered_hash = self.manifest.get_rendered_hash(new_yaml_frontmatter)
         file_exists = exists(file_path)
         if file_exists:
+            if self.manifest.is_unchanged(code, stat(file_path), rendered_hash):
+                logger.debug(f"No changes in {code}.md or its citation data since it was last checked, no update made")
+                return
             with open(file_path, "r", encoding=read_encoding) as f:
                 file_content = f.read()
             content_lst = file_content.split(self.yaml_separator)
+            if self.manifest.has_same_frontmatter(code, content_lst[1], rendered_hash):
+                logger.debug(f"Only the note text of {code}.md changed since it was last checked, no update made")
+                self.manifest.record(code, file_path, content_lst[1], rendered_hash)
+                return
             new_yaml_frontmatter = update_frontmatter(content_lst[1], new_yaml_frontmatter)
             if new_yaml_frontmatter is None:
                 logger.debug(f"No changes detected in yaml frontmatter of {code}.md, no update made")
+                self.manifest.record(code, file_path, content_lst[1], rendered_hash)
                 return
-            self.file_collection.record_updated(file_path, file_content)
         else:
             content_lst = [""] * 3
             self.file_collection.record_created(file_path)
         content_lst[1] = new_yaml_frontmatter
-        with open(file_path, "w", encoding=write_encoding) as f:
+        with atomic_open(file_path, "w", encoding=write_encoding) as f:
             f.write(self.yaml_separator.join(content_lst))
+        self.manifest.record(code, file_path, new_yaml_frontmatter, rendered_hash)
         logger.progress(("Updated" if file_exists else "Created") + f" markdown file {code}.md")
 
+    def rebuild_files(self, entries):
+        """
+        Re-renders and merges the notes for a list of (citation_dict, cited_links_lst) pairs
+        using a pool of workers, without using the network.
+        """
+        if self.dir_name is None:
+            return
+        start_time = perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, md_num_workers)) as executor:
+            for _ in executor.map(lambda entry: self.create_or_update_file(*entry), entries):
+                pass
+        elapsed_time = perf_counter() - start_time
+        files_per_second = len(entries) / elapsed_time if elapsed_time > 0 else float("inf")
+        logger.progress(f"Rebuilt {len(entries)} markdown files in {elapsed_time:.2f} seconds ({files_per_second:.1f} files per second)")
+
+    def save_manifest(self):
+        if self.dir_name is None:
+            return
+        self.manifest.save_file()
+
+    def save_snapshot(self):
+        """Saves the list of markdown files in the snapshot. Only valid once all files are saved."""
+        if self.dir_name is None:
+            return
+        snapshot.set("markdown", self.dir_name, sorted(self.file_collection.get_current_md_file_paths()))
+
     def delete_unmatched_files(self, citation_codes_lst):
         if self.dir_name is None or not delete_unmatched_citations:
             return
@@ -89,50 +174,53 @@ class Markdowns:
                 logger.warning(f"The file {citation_codes_lst[code_indx]}.md exists, but the citation code is {code}. It is assumed that this code connects to this file, since many computers have case-insensitive file naming. If that is not the case, please rename the file.")
             elif code not in citation_codes_lst:
                 file_path = self._get_file_path(code)
-                with open(file_path, "r", encoding=read_encoding) as f:
-                    self.file_collection.record_deleted(file_path, f.read())
+                self.file_collection.record_deleted(file_path)
+                self.manifest.remove(code)
                 logger.progress(f"Deleting markdown file {file_path.rsplit('/',1)[1]} since it is missing from the citations csv")
-                remove(file_path)
+                remove_file(file_path)
 
-    def change_citation_code(self, old_code, new_code, cited_by_lst):
-        if self.dir_name is None:
+    def change_citation_codes(self, renamed_codes, cited_by_dict):
+        """
+        Renames the files for all codes in renamed_codes (old code: new code), then rewrites
+        each affected file once, exchanging all renamed links in a single substitution.
+        cited_by_dict gives the (old) codes citing each renamed code.
+        """
+        if self.dir_name is None or len(renamed_codes) == 0:
             return
-        old_file_path, new_file_path = [self._get_file_path(code) for code in (old_code, new_code)]
-        # rename file
-        rename(old_file_path, new_file_path)
-        logger.progress(f"File {old_code}.md changed to {new_code}.md, and yaml frontmatter updated if necessary")
-        # collect old content
-        with open(new_file_path, "r", encoding=read_encoding) as f:
-            old_content = f.read()
-            self.file_collection.record_code_changed(new_file_path, old_file_path, old_content)
-        # update pdf link in yaml frontmatter if necessary
-        if (automate_pdf_link_article or automate_pdf_link_book) and make_md_link(old_code, pdf=True) in old_content:
-            with open(new_file_path, "w", encoding=write_encoding) as f:
-                new_content = old_content.replace(make_md_link(old_code, pdf=True), make_md_link(new_code, pdf=True))
+        # rename files
+        for old_code, new_code in renamed_codes.items():
+            old_file_path, new_file_path = [self._get_file_path(code) for code in (old_code, new_code)]
+            rename_file(old_file_path, new_file_path)
+            self.file_collection.record_code_changed(new_file_path, old_file_path)
+            self.manifest.remove(old_code)
+            logger.progress(f"File {old_code}.md changed to {new_code}.md, and yaml frontmatter updated if necessary")
+        # collect links to exchange in each file, as (old code, is pdf link)
+        links_to_exchange = {}
+        for old_code, new_code in renamed_codes.items():
+            if automate_pdf_link_article or automate_pdf_link_book:
+                links_to_exchange.setdefault(new_code, set()).add((old_code, True))
+            if link_cited and cited_by_dict.get(old_code) is not None:
+                for code in cited_by_dict[old_code]:
+                    links_to_exchange.setdefault(renamed_codes.get(code, code), set()).add((old_code, False))
+        # exchange links
+        link_pattern = re.compile(
+            "\"\\[\\[(" + "|".join(re.escape(code) for code in sorted(renamed_codes, key=len, reverse=True)) + ")(\\.pdf)?\\]\\]\""
+        )
+        for code, links in links_to_exchange.items():
+            file_path = self._get_file_path(code)
+            with open(file_path, "r", encoding=read_encoding) as f:
+                old_content = f.read()
+            exchange_link = lambda match: make_md_link(renamed_codes[match.group(1)], pdf=match.group(2) is not None) \
+                if (match.group(1), match.group(2) is not None) in links else match.group(0)
+            new_content = link_pattern.sub(exchange_link, old_content)
+            if new_content == old_content:
+                continue
+            with atomic_open(file_path, "w", encoding=write_encoding) as f:
                 f.write(new_content)
-        # update md docs that cite this citation code
-        if link_cited and cited_by_lst is not None:
-            for code in cited_by_lst:
-                file_path = self._get_file_path(code)
-                with open(file_path, "r", encoding=read_encoding) as f:
-                    old_content = f.read()
-                self.file_collection.record_updated(file_path, old_content, check_created=True)
-                new_content = old_content.replace(make_md_link(old_code), make_md_link(new_code))
-                with open(file_path, "w", encoding=write_encoding) as f:
-                    f.write(new_content)
-                logger.progress(f"File {code}.md changed so that its citation to {old_code} was exchanged for {new_code}")
+            exchanged_codes = sorted(old_code for old_code, is_pdf_link in links if not is_pdf_link)
+            if len(exchanged_codes) > 0:
+                logger.progress(f"File {code}.md changed so that its citations to {', '.join(exchanged_codes)} were exchanged for {', '.join(renamed_codes[old_code] for old_code in exchanged_codes)}")
     
-    def revert_files(self):
-        for file_path in self.file_collection.get_created_files():
-            remove(file_path)
-        for new_file_path, old_file_path, old_content in self.file_collection.get_code_change_files():
-            remove(new_file_path)
-            with open(old_file_path, "w", encoding=write_encoding) as f:
-                f.write(old_content)
-        for file_path, content in self.file_collection.get_updated_or_deleted_files().items():
-            with open(old_file_path, "w", encoding=write_encoding) as f:
-                f.write(content)
-
     def _get_yaml_frontmatter(self, citation_dict, cited_links_lst=None):
         yaml_text = ""
         get_detail = lambda key, string=None, whitespace=" ": f"{key}:{whitespace}{citation_dict[key] if string is None else string}\n"
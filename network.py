@@ -0,0 +1,217 @@
+from aux import logger, pool_size, rate_limits, \
+    timeout, min_timeout, retry_delay, max_retry_delay, breaker_threshold, breaker_cooldown
+from threading import Lock, get_ident
+from time import monotonic, sleep
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import random
+import re
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+import requests
+
+_sessions = {}
+_sessions_lock = Lock()
+_backends = {}
+_backends_lock = Lock()
+_rate_limiters = {}
+_rate_limiters_lock = Lock()
+
+def get_session(url:str) -> requests.Session:
+    """Returns the pooled keep-alive session for the host of the given url, creating it if necessary."""
+    host = urlsplit(url).netloc
+    with _sessions_lock:
+        if host not in _sessions:
+            logger.debug(f"Creating pooled http session for {host} with pool size {pool_size}")
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({
+                "Accept": "application/json",
+                "Accept-Encoding": "gzip, deflate",
+            })
+            _sessions[host] = session
+        return _sessions[host]
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+class BackendHealth:
+    """
+    Health of one api backend, shared by all requests to it. Consecutive failures open a
+    circuit breaker that skips the backend until a cool-down passes, after which a single
+    trial request decides whether it is closed again. Timeouts adapt to recent latency.
+    """
+    latency_weight = 0.3    # weight of newest latency in moving average
+    timeout_factor = 4      # adaptive timeout as a multiple of average latency
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = Lock()
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self.trial_thread = None
+        self.average_latency = None
+
+    def allow_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_in_progress or monotonic() - self.opened_at < breaker_cooldown:
+                return False
+            logger.debug(f"{self.name}: cool-down over, sending a trial request")
+            self.trial_in_progress = True
+            self.trial_thread = get_ident()
+            return True
+
+    def end_attempt(self):
+        """Called after every allowed request, so a trial that recorded no result can be sent again later."""
+        with self.lock:
+            if self.trial_in_progress and self.trial_thread == get_ident():
+                logger.debug(f"{self.name}: trial request ended without a result")
+                self.trial_in_progress = False
+                self.trial_thread = None
+
+    def get_timeout(self):
+        with self.lock:
+            if self.average_latency is None:
+                return timeout
+            return min(timeout, max(min_timeout, self.average_latency * self.timeout_factor))
+
+    def get_backoff_delay(self, attempt_indx):
+        delay = min(max_retry_delay, retry_delay * 2 ** attempt_indx)
+        return random.uniform(delay / 2, delay)
+
+    def record_success(self, latency=None):
+        with self.lock:
+            if latency is not None:
+                self._update_latency(latency)
+            if self.opened_at is not None:
+                logger.progress(f"{self.name}: api is responding again")
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self, latency=None):
+        with self.lock:
+            if latency is not None:
+                self._update_latency(latency)
+            self.consecutive_failures += 1
+            if self.trial_in_progress or (self.opened_at is None and self.consecutive_failures >= breaker_threshold):
+                logger.progress(f"{self.name}: api failed {self.consecutive_failures} times in a row, skipping it for {breaker_cooldown} seconds")
+                self.opened_at = monotonic()
+                self.trial_in_progress = False
+
+    def _update_latency(self, latency):
+        if self.average_latency is None:
+            self.average_latency = latency
+        else:
+            self.average_latency += self.latency_weight * (latency - self.average_latency)
+
+def get_backend_health(name:str) -> BackendHealth:
+    """Returns the shared health tracker for the named api backend, creating it if necessary."""
+    with _backends_lock:
+        if name not in _backends:
+            _backends[name] = BackendHealth(name)
+        return _backends[name]
+
+class RateLimiter:
+    """
+    Token bucket shared by all requests to one api. Starts at the rate in settings.json,
+    then follows the X-Rate-Limit-Limit and X-Rate-Limit-Interval headers sent by the api,
+    halving its rate and pausing for Retry-After whenever a 429 response is received. The
+    halved rate stays a ceiling on the header rate until a cool-down passes without a 429.
+    """
+    min_rate = 0.1          # requests per second
+    ceiling_cooldown = 60   # seconds a lowered rate is kept after a 429 response
+
+    def __init__(self, name, rate=None):
+        self.name = name
+        self.lock = Lock()
+        self.rate = None
+        self.tokens = 0
+        self.updated_at = monotonic()
+        self.paused_until = 0
+        self.ceiling = None     # highest rate allowed after a 429 response
+        self.ceiling_until = 0
+        self._set_rate(rate, "settings.json")
+        self.tokens = self.capacity
+
+    @property
+    def capacity(self):
+        return max(1, self.rate) if self.rate is not None else 1
+
+    def acquire(self, cancel_event=None):
+        """Waits until a request may be sent, returning False if cancel_event was set first."""
+        while True:
+            with self.lock:
+                now = monotonic()
+                if self.rate is None and now >= self.paused_until:
+                    return True
+                if self.rate is not None:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                delay = max(self.paused_until - now, (1 - self.tokens) / self.rate if self.rate is not None else 0)
+            if cancel_event is None:
+                sleep(delay)
+            elif cancel_event.wait(delay):
+                return False
+
+    def update_from_response(self, response):
+        limit, interval = response.headers.get("X-Rate-Limit-Limit"), response.headers.get("X-Rate-Limit-Interval")
+        if limit is not None and interval is not None:
+            interval_seconds = _parse_interval(interval)
+            if limit.isdigit() and interval_seconds is not None and interval_seconds > 0:
+                with self.lock:
+                    header_rate = int(limit) / interval_seconds
+                    if self.ceiling is not None and monotonic() < self.ceiling_until:
+                        header_rate = min(header_rate, self.ceiling)
+                    self._set_rate(header_rate, "api headers")
+        if response.status_code == 429:
+            retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+            with self.lock:
+                self._set_rate(self.rate / 2 if self.rate is not None else None, "429 response")
+                self.ceiling, self.ceiling_until = self.rate, monotonic() + self.ceiling_cooldown
+                if retry_after is not None:
+                    self.paused_until = max(self.paused_until, monotonic() + retry_after)
+                    logger.debug(f"{self.name}: pausing requests for {retry_after:.1f} seconds as asked by api")
+                self.tokens = 0
+
+    def _set_rate(self, rate, source):
+        if rate is not None:
+            rate = max(self.min_rate, rate)
+        if rate != self.rate:
+            self.rate = rate
+            rate_string = "unlimited" if rate is None else f"{rate:.2f} requests per second"
+            logger.debug(f"{self.name}: rate limit set to {rate_string} from {source}")
+
+def _parse_interval(interval):
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*(ms|s|m|h)?\s*", interval)
+    if match is None:
+        return None
+    return float(match.group(1)) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[match.group(2) or "s"]
+
+def _parse_retry_after(retry_after):
+    if retry_after is None:
+        return None
+    if retry_after.strip().isdigit():
+        return float(retry_after)
+    try:
+        return max(0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def get_rate_limiter(name:str, api_name:str) -> RateLimiter:
+    """Returns the shared rate limiter for the named api backend, creating it if necessary."""
+    with _rate_limiters_lock:
+        if name not in _rate_limiters:
+            _rate_limiters[name] = RateLimiter(name, rate_limits.get(api_name))
+        return _rate_limiters[name]
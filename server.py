@@ -0,0 +1,197 @@
+from aux import logger, serve_port, storage, csv_file_name, library_db_file_name, CommandCiteError, \
+    get_id_num_type, format_base_citation_code
+from journal import journal
+from snapshot import get_source_key
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from threading import Thread, Event
+from queue import Queue
+import json
+
+
+class _LibraryWorker:
+    """
+    Runs every request on one thread that owns the library, in the order received, so
+    requests sent at the same time can never change the citations csv at the same time.
+    Each change is saved and committed before the next request starts, and all files are
+    read again first if the citations csv was changed by something else since.
+    """
+    def __init__(self, library):
+        self.library = library
+        self.csv_source_key = _get_csv_source_key()
+        self.jobs = Queue()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, function, *args):
+        """Waits for function(library, *args) to run on the worker, returning (status, result)."""
+        job = {"function": function, "args": args, "done": Event()}
+        self.jobs.put(job)
+        job["done"].wait()
+        return job["status"], job["result"]
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            if _get_csv_source_key() != self.csv_source_key:
+                logger.progress("The citations csv was changed outside of this server, so all files are read again")
+                logger.progress_newline()
+                self.library.reload()
+            try:
+                job["status"], job["result"] = 200, job["function"](self.library, *job["args"])
+                journal.commit()
+            except Exception as e:
+                # undo partly saved files and read them again for the next request
+                journal.rollback()
+                self.library.reload()
+                if isinstance(e, CommandCiteError):
+                    job["status"], job["result"] = 400, {"error": str(e)}
+                else:
+                    logger.progress(f"Request failed ({type(e).__name__}: {e})")
+                    logger.progress_newline()
+                    job["status"], job["result"] = 500, {"error": f"{type(e).__name__}: {e}"}
+            finally:
+                self.csv_source_key = _get_csv_source_key()
+                job["done"].set()
+
+def _get_csv_source_key():
+    return get_source_key(library_db_file_name if storage == "sqlite" else csv_file_name)
+
+
+def _add(library, id_nums, set_codes):
+    entry_infos = []
+    for id_num in id_nums:
+        id_num_type = get_id_num_type(id_num)
+        if id_num_type is None:
+            logger.error("Unrecognized Argument", f"The argument {id_num} was expected to be a DOI or an ISBN, but follows the format of neither. DOIs take the form \"10.xxxx/abcd\", whereas ISBNs are just numbers.")
+        set_code = set_codes.get(id_num)
+        entry_infos.append((id_num, id_num_type, None if set_code is None else format_base_citation_code(set_code)))
+    added_codes, unfetched_entry_infos = library.add_entries(entry_infos)
+    library.save()
+    return {"added": added_codes, "not-found": [entry_info[0] for entry_info in unfetched_entry_infos]}
+
+def _update(library, codes):
+    all_codes = library.get_all_citation_codes()
+    if codes is None:
+        codes = all_codes
+    for code in codes:
+        if code not in all_codes:
+            logger.error("Code Does Not Exist", f"The citation code \"{code}\" was not found in the citations csv")
+    unfetched_codes = library.update_entries(codes)
+    library.save()
+    return {"updated": [code for code in codes if code not in unfetched_codes], "not-found": unfetched_codes}
+
+def _rename(library, new_base_codes):
+    all_codes = library.get_all_citation_codes()
+    for code in new_base_codes:
+        if code not in all_codes:
+            logger.error("Code Does Not Exist", f"The citation code \"{code}\" was not found in the citations csv")
+    renamed_codes = library.rename_entries({code: format_base_citation_code(new_base_code) for code, new_base_code in new_base_codes.items()})
+    library.save()
+    return {"renamed": renamed_codes}
+
+def _lookup(library, field, value):
+    csv = library.csv
+    if field == "code":
+        codes = [value] if value in csv.get_all_citation_codes() else []
+    else:
+        codes = csv.find_codes_by_id_num(value, field)
+    return {
+        "entries": [
+            {
+                "entry": dict(csv.get_entry(code)),
+                "cites": csv.get_codes_cited_by_code(code) or [],
+                "cited-by": csv.get_codes_that_cite_code(code) or []
+            }
+            for code in codes
+        ]
+    }
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    worker = None
+    local_hosts = (f"127.0.0.1:{serve_port}", f"localhost:{serve_port}")
+
+    def do_GET(self):
+        if not self._is_local_request():
+            return self._send(403, {"error": "Requests must be sent to this computer, not from a web page"})
+        url = urlparse(self.path)
+        if url.path != "/lookup":
+            return self._send(404, {"error": f"Unknown path {url.path}. Use /lookup, /add, /update, or /rename."})
+        query = parse_qs(url.query)
+        fields = [field for field in ("code", "doi", "isbn") if field in query]
+        if len(fields) != 1:
+            return self._send(400, {"error": "Give exactly one of code, doi, or isbn, such as /lookup?doi=10.xxxx/abcd"})
+        self._send(*self.worker.submit(_lookup, fields[0], query[fields[0]][0]))
+
+    def do_POST(self):
+        if not self._is_local_request():
+            return self._send(403, {"error": "Requests must be sent to this computer, not from a web page"})
+        # web pages can only send other content types without the browser asking first
+        if self.headers.get_content_type() != "application/json":
+            return self._send(415, {"error": "The request body must be sent with \"Content-Type: application/json\""})
+        url = urlparse(self.path)
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not isinstance(body, dict):
+                raise ValueError
+        except ValueError:
+            return self._send(400, {"error": "The request body must be a JSON object"})
+        if url.path == "/add" and _is_str_list(body.get("ids")) and isinstance(body.get("setcodes", {}), dict):
+            self._send(*self.worker.submit(_add, body["ids"], body.get("setcodes", {})))
+        elif url.path == "/update" and (body.get("all") is True or _is_str_list(body.get("codes"))):
+            self._send(*self.worker.submit(_update, None if body.get("all") is True else body["codes"]))
+        elif url.path == "/rename" and isinstance(body.get("codes"), dict) and len(body["codes"]) > 0:
+            self._send(*self.worker.submit(_rename, body["codes"]))
+        elif url.path in ("/add", "/update", "/rename"):
+            self._send(400, {"error": "Expected {\"ids\": [...], \"setcodes\": {id: code}} for /add, {\"codes\": [...]} or {\"all\": true} for /update, and {\"codes\": {code: new base code}} for /rename"})
+        else:
+            self._send(404, {"error": f"Unknown path {url.path}. Use /lookup, /add, /update, or /rename."})
+
+    def _is_local_request(self):
+        """
+        Returns False for requests made by web pages, which send an Origin header, and for
+        requests to other host names, which a web page could make resolve to this computer.
+        """
+        origin = self.headers.get("Origin")
+        if origin is not None and urlparse(origin).netloc not in self.local_hosts:
+            return False
+        return self.headers.get("Host") in self.local_hosts
+
+    def _send(self, status, result):
+        body = json.dumps(result, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Request from {self.address_string()}: {format % args}")
+
+def _is_str_list(value):
+    return isinstance(value, list) and len(value) > 0 and all(isinstance(item, str) for item in value)
+
+
+def serve(library):
+    """Answers requests at http://127.0.0.1:<serve_port> with the library kept in memory, until interrupted."""
+    # read all files before serving, so the first request is as fast as the rest
+    library.csv, library.md, library.bibtex, library.hayagriva
+    _RequestHandler.worker = _LibraryWorker(library)
+    server = ThreadingHTTPServer(("127.0.0.1", serve_port), _RequestHandler)
+    logger.progress(f"Serving at http://127.0.0.1:{serve_port} (press Ctrl+C to stop)", title_message=True)
+    logger.progress_newline()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.progress("Stopped serving", title_message=True)
+        logger.progress_newline()
+    finally:
+        server.server_close()
+        _RequestHandler.worker.close()
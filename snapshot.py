@@ -0,0 +1,93 @@
+from aux import logger, settings, snapshot_file_name, use_snapshot
+from hashlib import blake2b
+from os import stat, replace, remove, fdopen
+from os.path import abspath, dirname, basename, exists
+from tempfile import mkstemp
+import pickle
+import json
+
+
+class Snapshot:
+    """
+    Parsed state of the citations csv, bibliography files, and markdown folder, saved in one
+    pickle file next to the citations csv. Each part is only used while its source file or
+    folder has the same size, modification time, and inode as when the part was saved, and
+    settings.json is unchanged. Otherwise the source is parsed as usual.
+    """
+    version = 4
+
+    def __init__(self, file_name, enabled=True):
+        self.file_name = file_name
+        self.enabled = enabled
+        self.parts = None # name: (source key, state), read from file when first needed
+        self.has_changed = False
+        self.settings_hash = blake2b(json.dumps(settings, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
+
+    def _load(self):
+        if self.parts is not None:
+            return
+        self.parts = {}
+        if self.enabled and exists(self.file_name):
+            try:
+                with open(self.file_name, "rb") as f:
+                    data = pickle.load(f)
+                if data["version"] == self.version and data["settings_hash"] == self.settings_hash:
+                    self.parts = data["parts"]
+                else:
+                    logger.debug("Snapshot is from other settings or another version, so it is not used")
+            except Exception:
+                logger.debug("Snapshot could not be read, so all files are parsed")
+
+    def get(self, name, source_path):
+        """Returns the saved state for a part if its source is unchanged, otherwise None."""
+        if not self.enabled:
+            return None
+        self._load()
+        if name not in self.parts:
+            return None
+        source_key, state = self.parts[name]
+        if source_key is None or source_key != get_source_key(source_path):
+            logger.debug(f"Snapshot of {name} is out of date")
+            return None
+        logger.debug(f"Using snapshot of {name}")
+        return state
+
+    def set(self, name, source_path, state):
+        if not self.enabled:
+            return
+        self._load()
+        self.parts[name] = (get_source_key(source_path), state)
+        self.has_changed = True
+
+    def reset(self):
+        """Forgets parts changed since the snapshot file was last saved, such as after a rollback."""
+        self.parts = None
+        self.has_changed = False
+
+    def save_file(self):
+        if not self.enabled or not self.has_changed:
+            return
+        logger.debug("Saving snapshot of parsed files")
+        # written atomically but not journaled, since an out of date snapshot is never used
+        file_descriptor, temp_path = mkstemp(dir=dirname(abspath(self.file_name)), prefix="." + basename(self.file_name), suffix=".tmp")
+        try:
+            with fdopen(file_descriptor, "wb") as f:
+                pickle.dump(
+                    {"version": self.version, "settings_hash": self.settings_hash, "parts": self.parts},
+                    f, protocol=pickle.HIGHEST_PROTOCOL
+                )
+            replace(temp_path, self.file_name)
+        except BaseException:
+            if exists(temp_path):
+                remove(temp_path)
+            raise
+        self.has_changed = False
+
+def get_source_key(source_path):
+    """Returns the size, modification time, and inode of a file or folder, or None if missing."""
+    if source_path is None or not exists(source_path):
+        return None
+    source_stat = stat(source_path)
+    return (source_stat.st_size, source_stat.st_mtime_ns, source_stat.st_ino)
+
+snapshot = Snapshot(snapshot_file_name, use_snapshot)
@@ -0,0 +1,224 @@
+from aux import logger, library_db_file_name, csv_file_name, program_headers, info_headers, \
+    write_encoding, array_separator, missing_data_string, \
+    get_citation_code_parts, get_code_suffix_from_int, get_int_from_code_suffix, has_data, check_directory
+from journal import journal, atomic_open
+from os.path import dirname
+import sqlite3
+import json
+import csv
+
+
+class SQLiteCSV:
+    """
+    The citations csv kept in an sqlite database next to it instead (citations_csv.storage
+    set to "sqlite"), with the same methods as CSV. Entries are read and written one row at
+    a time through indexes on citation code, doi, isbn, and cited dois, and all changes of a
+    run are one transaction that the journal commits or rolls back along with the files.
+    """
+    schema_version = 1
+    def __init__(self):
+        logger.debug("Opening citations database")
+        self.file_name = library_db_file_name
+        check_directory(dirname(self.file_name))
+        self.connection = sqlite3.connect(self.file_name, check_same_thread=False)
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] not in (0, self.schema_version):
+            logger.error("Unknown Database Version", f"The citations database {self.file_name} was made by another version of this program")
+        self.connection.execute(f"PRAGMA user_version = {self.schema_version}")
+        self.connection.executescript(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "row_indx INTEGER PRIMARY KEY, code TEXT NOT NULL UNIQUE, base_code TEXT NOT NULL, doi TEXT, isbn TEXT, "
+            "has_empty_cells INTEGER NOT NULL, row TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS entries_base_code ON entries (base_code);"
+            "CREATE INDEX IF NOT EXISTS entries_doi ON entries (doi);"
+            "CREATE INDEX IF NOT EXISTS entries_isbn ON entries (isbn);"
+            "CREATE INDEX IF NOT EXISTS entries_lower_doi ON entries (lower(doi));"
+            "CREATE INDEX IF NOT EXISTS entries_lower_isbn ON entries (lower(isbn));"
+            "CREATE INDEX IF NOT EXISTS entries_has_empty_cells ON entries (has_empty_cells);"
+            "CREATE TABLE IF NOT EXISTS cited (citing_code TEXT NOT NULL, cited_doi TEXT NOT NULL, PRIMARY KEY (citing_code, cited_doi));"
+            "CREATE INDEX IF NOT EXISTS cited_cited_doi ON cited (cited_doi);"
+            "CREATE TABLE IF NOT EXISTS headers (position INTEGER PRIMARY KEY, header TEXT NOT NULL);"
+        )
+        journal.add_connection(self.connection)
+        self.all_headers = tuple(header for (header,) in self.connection.execute("SELECT header FROM headers ORDER BY position"))
+        if len(self.all_headers) == 0:
+            self.all_headers = tuple(program_headers + info_headers)
+        self.base_citation_code_count = {} # base code: suffixes used this run, read from the database when first needed
+
+    def add_from_api(self, citation_dict):
+        base_citation_code = citation_dict["citation-code"]
+        logger.debug(f"Adding suffix to base citation code {base_citation_code} and adding to citations database")
+        citation_dict["citation-code"] = base_citation_code + self._get_next_code_suffix(base_citation_code)
+        full_dict = {header: "" for header in self.all_headers}
+        full_dict.update(citation_dict)
+        self._insert_row(full_dict)
+        logger.progress(f"Added citation code {citation_dict['citation-code']} to entry, and added entry to citations database")
+        return citation_dict
+
+    def save_file(self):
+        # the transaction is committed by journal.commit, once all other files are saved too
+        logger.debug("Saving citations database")
+        # as when the csv is read again, suffixes of codes no longer in use can be used again
+        self.base_citation_code_count = {}
+
+    def save_snapshot(self):
+        pass # the database is not parsed, so there is nothing to save
+
+    def close(self):
+        """Closes the database, undoing changes not committed by the journal."""
+        if self.connection is not None:
+            journal.remove_connection(self.connection)
+            self.connection.rollback()
+            self.connection.close()
+            self.connection = None
+
+    def get_entry(self, citation_code):
+        row = self.connection.execute("SELECT row FROM entries WHERE code = ?", (citation_code,)).fetchone()
+        if row is None:
+            logger.error("Specified Code Does Not Exist", f"The citation code \"{citation_code}\" is not found in the citations database.")
+        return json.loads(row[0])
+
+    def update_entry(self, citation_code, new_citation_dict):
+        old_citation_dict = self.get_entry(citation_code)
+        if _has_empty_program_cells(old_citation_dict):
+            for header, cell in old_citation_dict.items():
+                if cell == "":
+                    old_citation_dict[header] = new_citation_dict[header]
+            self._update_row(citation_code, old_citation_dict)
+            logger.progress(f"Updated missing data in {citation_code} in citations database")
+        else:
+            logger.debug(f"No missing data found in {citation_code}")
+
+    def fill_missing_cells(self, code):
+        citation_dict = self.get_entry(code)
+        if _has_empty_program_cells(citation_dict):
+            for header in info_headers:
+                if citation_dict[header] == "":
+                    citation_dict[header] = missing_data_string
+            self._update_row(code, citation_dict)
+            logger.debug(f"Filling empty cells of {code} in citations database")
+
+    def get_entries_needing_updating(self):
+        return tuple(code for (code,) in self.connection.execute("SELECT code FROM entries WHERE has_empty_cells = 1 ORDER BY row_indx"))
+
+    def get_all_id_nums(self):
+        id_nums = {"doi": [], "isbn": []}
+        for id_num_type in ("doi", "isbn"):
+            id_nums[id_num_type] = [id_num for (id_num,) in self.connection.execute(f"SELECT {id_num_type} FROM entries WHERE {id_num_type} IS NOT NULL ORDER BY row_indx")]
+        return id_nums
+
+    def get_all_citation_codes(self):
+        return tuple(code for (code,) in self.connection.execute("SELECT code FROM entries ORDER BY row_indx"))
+
+    def change_citation_code(self, current_code, new_base_code):
+        logger.debug(f"Changing citation code {current_code} to have base code of {new_base_code}")
+        citation_dict = self.get_entry(current_code)
+        new_code = new_base_code + self._get_next_code_suffix(new_base_code)
+        citation_dict["citation-code"] = new_code
+        self.connection.execute(
+            "UPDATE entries SET code = ?, base_code = ?, row = ? WHERE code = ?",
+            (new_code, get_citation_code_parts(new_code)[0], json.dumps(citation_dict), current_code)
+        )
+        self.connection.execute("UPDATE cited SET citing_code = ? WHERE citing_code = ?", (new_code, current_code))
+        logger.progress(f"Citation code {current_code} changed to {new_code} in citations database")
+        return new_code
+
+    def change_citation_codes(self, new_base_codes):
+        """Renames each code in new_base_codes (code: new base code), returning {old code: new code}."""
+        return {
+            current_code: self.change_citation_code(current_code, new_base_code)
+            for current_code, new_base_code in new_base_codes.items()
+        }
+
+    def get_codes_that_cite_code(self, code):
+        id_num = self.get_entry(code)["doi"]
+        if not has_data(id_num):
+            return None
+        citing_codes = [citing_code for (citing_code,) in self.connection.execute(
+            "SELECT cited.citing_code FROM cited JOIN entries ON entries.code = cited.citing_code "
+            "WHERE cited.cited_doi = ? ORDER BY entries.row_indx", (id_num,)
+        )]
+        return citing_codes if len(citing_codes) > 0 else None
+
+    def get_codes_cited_by_code(self, code):
+        self.get_entry(code)
+        code_lst = [cited_code for (cited_code,) in self.connection.execute(
+            "SELECT DISTINCT entries.code FROM cited JOIN entries ON entries.doi = cited.cited_doi "
+            "WHERE cited.citing_code = ?", (code,)
+        )]
+        return sorted(code_lst) if len(code_lst) > 0 else None
+
+    def find_codes_by_id_num(self, id_num, id_num_type):
+        """Returns the codes of entries with the given doi or isbn (ignoring case), in row order."""
+        return [code for (code,) in self.connection.execute(
+            f"SELECT code FROM entries WHERE lower({id_num_type}) = ? ORDER BY row_indx", (id_num.lower(),)
+        )]
+
+    def import_csv(self, csv_file):
+        """Replaces all entries with those of a CSV object, keeping its headers and row order."""
+        logger.progress(f"Importing {csv_file.file_name} into citations database")
+        for table in ("entries", "cited", "headers"):
+            self.connection.execute(f"DELETE FROM {table}")
+        self.all_headers = csv_file.all_headers
+        self.connection.executemany("INSERT INTO headers (position, header) VALUES (?, ?)", enumerate(self.all_headers))
+        for code in csv_file.get_all_citation_codes():
+            citation_dict = {header: "" for header in self.all_headers}
+            citation_dict.update(csv_file.get_entry(code))
+            self._insert_row(citation_dict)
+        self.base_citation_code_count = {}
+        logger.progress(f"Imported {len(csv_file.get_all_citation_codes())} entries")
+
+    def export_csv(self):
+        """Writes all entries to the citations csv, so they can be edited in a spreadsheet program."""
+        logger.progress(f"Exporting citations database to {csv_file_name}")
+        with atomic_open(csv_file_name, "w", encoding=write_encoding, newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=self.all_headers)
+            writer.writeheader()
+            for (row,) in self.connection.execute("SELECT row FROM entries ORDER BY row_indx"):
+                writer.writerow(json.loads(row))
+
+    def _get_next_code_suffix(self, base_code):
+        if base_code not in self.base_citation_code_count:
+            self.base_citation_code_count[base_code] = max((
+                get_int_from_code_suffix(get_citation_code_parts(code)[1])
+                for (code,) in self.connection.execute("SELECT code FROM entries WHERE base_code = ?", (base_code,))
+            ), default=0)
+        self.base_citation_code_count[base_code] += 1
+        return get_code_suffix_from_int(self.base_citation_code_count[base_code])
+
+    def _insert_row(self, citation_dict):
+        citation_dict = _get_saved_row(citation_dict)
+        code = citation_dict["citation-code"]
+        if self.connection.execute("SELECT 1 FROM entries WHERE code = ?", (code,)).fetchone() is not None:
+            logger.error("Repeat Citation Codes Found", f"Citation code \"{code}\" found multiple times in citations database. Please manually input a unique and valid citation code for the repeat rows.")
+        self.connection.execute(
+            "INSERT INTO entries (code, base_code, doi, isbn, has_empty_cells, row) VALUES (?, ?, ?, ?, ?, ?)",
+            (code, get_citation_code_parts(code)[0], *_get_id_num_columns(citation_dict), _has_empty_program_cells(citation_dict), json.dumps(citation_dict))
+        )
+        self._index_cited_dois(code, citation_dict)
+
+    def _update_row(self, code, citation_dict):
+        citation_dict = _get_saved_row(citation_dict)
+        self.connection.execute(
+            "UPDATE entries SET doi = ?, isbn = ?, has_empty_cells = ?, row = ? WHERE code = ?",
+            (*_get_id_num_columns(citation_dict), _has_empty_program_cells(citation_dict), json.dumps(citation_dict), code)
+        )
+        self.connection.execute("DELETE FROM cited WHERE citing_code = ?", (code,))
+        self._index_cited_dois(code, citation_dict)
+
+    def _index_cited_dois(self, code, citation_dict):
+        cited_dois = citation_dict["cited-dois"]
+        if has_data(cited_dois):
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO cited (citing_code, cited_doi) VALUES (?, ?)",
+                ((code, cited_doi) for cited_doi in cited_dois.split(array_separator))
+            )
+
+def _get_saved_row(citation_dict):
+    """Returns the row with all cells as strings, as reading it back from a csv would give."""
+    return {header: "" if cell is None else str(cell) for header, cell in citation_dict.items()}
+
+def _get_id_num_columns(citation_dict):
+    return tuple(citation_dict[id_num_type] if has_data(citation_dict[id_num_type]) else None for id_num_type in ("doi", "isbn"))
+
+def _has_empty_program_cells(citation_dict):
+    return any(citation_dict[header] == "" for header in info_headers)
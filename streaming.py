@@ -0,0 +1,116 @@
+from aux import logger
+from hashlib import blake2b
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# trie node meaning the whole value is kept
+_WHOLE = "whole"
+
+def is_streaming_available() -> bool:
+    return ijson is not None
+
+def build_address_trie(addresses:list[str]) -> dict:
+    """
+    Builds a trie of the parts of response addresses (as in \"csv_headers\" of settings.json),
+    with the value at the end of each address kept whole. Integer parts are list indices.
+    """
+    trie = {}
+    for address in addresses:
+        for address_option in address.split("|"):
+            _add_address_parts(trie, address_option.rstrip("@").split("."))
+    return trie
+
+def _add_address_parts(node:dict, address_parts:list[str]):
+    for part_indx, part in enumerate(address_parts):
+        if part.startswith("[") and part.endswith("]"):
+            for alternative_part in part[1:-1].split(","):
+                _add_address_parts(node, [alternative_part] + address_parts[part_indx+1:])
+            return
+        key = int(part) if part.isdigit() else part
+        if part_indx == len(address_parts) - 1:
+            node[key] = _WHOLE
+            return
+        if node.get(key) == _WHOLE:
+            return
+        node = node.setdefault(key, {})
+
+def get_trie_signature(trie:dict) -> str:
+    """Returns a short string identifying the trie, so that pruned responses can be told apart."""
+    return "pruned:" + blake2b(repr(_sort_trie(trie)).encode("utf-8"), digest_size=8).hexdigest()
+
+def _sort_trie(node):
+    if node == _WHOLE:
+        return node
+    return sorted(((str(key), _sort_trie(child)) for key, child in node.items()))
+
+def load_pruned(file, trie:dict):
+    """
+    Parses json from a file-like object as it is read, building only the values reached by
+    the trie. Skipped list items are kept as None so that list indices are unchanged.
+    """
+    root = None
+    stack = [] # [container, trie node, current key] of each open container
+    skip_depth = 0
+    for event, value in ijson.basic_parse(file, use_float=True):
+        if skip_depth > 0:
+            if event in ("start_map", "start_array"):
+                skip_depth += 1
+            elif event in ("end_map", "end_array"):
+                skip_depth -= 1
+            continue
+        if event == "map_key":
+            stack[-1][2] = value
+            continue
+        if event in ("end_map", "end_array"):
+            stack.pop()
+            continue
+        # a new value starts
+        if len(stack) == 0:
+            node = trie
+        else:
+            container, parent_node, key = stack[-1]
+            node = _get_child_node(parent_node, len(container) if isinstance(container, list) else key)
+            if node is None:
+                if isinstance(container, list):
+                    container.append(None)
+                if event in ("start_map", "start_array"):
+                    skip_depth = 1
+                continue
+        if event == "start_map":
+            new_value = {}
+        elif event == "start_array":
+            new_value = []
+        else:
+            new_value = value
+        if len(stack) == 0:
+            root = new_value
+        elif isinstance(stack[-1][0], list):
+            stack[-1][0].append(new_value)
+        else:
+            stack[-1][0][stack[-1][2]] = new_value
+        if event in ("start_map", "start_array"):
+            stack.append([new_value, node, None])
+    return root
+
+def _get_child_node(node, key):
+    if node == _WHOLE:
+        return _WHOLE
+    if isinstance(key, int):
+        indexed_node, all_node = node.get(key), node.get("*")
+        if indexed_node is None or all_node is None:
+            return indexed_node if indexed_node is not None else all_node
+        return _merge_nodes(indexed_node, all_node)
+    return node.get(key)
+
+def _merge_nodes(node1, node2):
+    if node1 == _WHOLE or node2 == _WHOLE:
+        return _WHOLE
+    merged_node = dict(node1)
+    for key, child in node2.items():
+        merged_node[key] = _merge_nodes(merged_node[key], child) if key in merged_node else child
+    return merged_node
+
+if ijson is None:
+    logger.debug("ijson is not installed, so api responses are parsed only once fully downloaded")